@@ -29,6 +29,9 @@ setup(name="hostout.pushdeploy",
       ],
       entry_points = {
           'zc.buildout':['default = hostout.pushdeploy:Recipe'],
-                         'fabric': ['fabfile = hostout.pushdeploy.fabfile']
+                         'fabric': ['fabfile = hostout.pushdeploy.fabfile'],
+          'console_scripts': [
+              'pushdeploy-benchmark = hostout.pushdeploy.benchmark:main'
+          ]
       },
       )
@@ -7,6 +7,23 @@ server.
 
 """
 
+BOOLEAN_OPTIONS = (
+    'local-sudo',
+    'remote-sudo',
+    'local-restart',
+    'single-pass-push',
+    'ssh-multiplex',
+    'rsync-chown',
+    'releases',
+    'report',
+    'parallel-stage',
+    'egg-manifest',
+    'changed-parts',
+    'artifact-push',
+    'rolling-restart',
+    'precompile',
+)
+
 
 class Recipe(object):
     """Dummy recipe to provide defaults for a pushdeploy-configuration
@@ -15,26 +32,13 @@ class Recipe(object):
     def __init__(self, buildout, name, options):
         self.name, self.options, self.buildout = name, options, buildout
 
-        # Set 'local-sudo'
-        local_sudo = self.options.get('local-sudo')
-        if local_sudo in (True, 'True', 'true', 'Yes', 'yes', 1, '1'):
-            self.options['local-sudo'] = 'true'
-        else:
-            self.options['local-sudo'] = 'false'
-
-        # Set 'remote-sudo'
-        remote_sudo = self.options.get('remote-sudo')
-        if remote_sudo in (True, 'True', 'true', 'Yes', 'yes', 1, '1'):
-            self.options['remote-sudo'] = 'true'
-        else:
-            self.options['remote-sudo'] = 'false'
-
-        # Set 'local-restart'
-        local_sudo = self.options.get('local-restart')
-        if local_sudo in (True, 'True', 'true', 'Yes', 'yes', 1, '1'):
-            self.options['local-restart'] = 'true'
-        else:
-            self.options['local-restart'] = 'false'
+        # Set boolean options ('local-sudo', 'remote-sudo', etc.)
+        for option in BOOLEAN_OPTIONS:
+            value = self.options.get(option)
+            if value in (True, 'True', 'true', 'Yes', 'yes', 1, '1'):
+                self.options[option] = 'true'
+            else:
+                self.options[option] = 'false'
 
     def install(self):
         return []
@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+"""Benchmark for the pushdeploy push, pull and deploy commands.
+
+Creates a synthetic buildout (with eggs, parts, Data.fs and blobstorage) and
+runs the commands against a "remote" site on the same machine: a fake ssh
+command runs the remote commands (including rsync's server side) locally
+with the buildout path rewritten into a separate remote root and counts the
+bytes passed through it. Every command is run for cold, warm and no-change
+scenarios and wall time, bytes on the wire, child CPU time and I/O counters
+are reported. No network access (nor sshd) is required.
+
+"""
+import argparse
+import getpass
+import json
+import os
+import random
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from fabric.api import env
+from fabric.api import hide
+
+from hostout.pushdeploy import fabfile
+
+
+# The fake ssh command: runs the given command locally with the buildout
+# path rewritten into the remote root and logs the bytes it passes through
+FAKE_SSH = '''#!{executable:s}
+import os
+import subprocess
+import sys
+import threading
+
+OPTIONS_WITH_VALUE = ('-b', '-c', '-D', '-E', '-e', '-F', '-I', '-i', '-J',
+                      '-L', '-l', '-m', '-O', '-o', '-p', '-Q', '-R', '-S',
+                      '-W', '-w')
+
+args = sys.argv[1:]
+while args and args[0].startswith('-'):
+    option = args.pop(0)
+    if option in OPTIONS_WITH_VALUE:
+        args.pop(0)
+host, command = args[0], ' '.join(args[1:])
+command = command.replace({path!r}, {remote_path!r})
+
+process = subprocess.Popen(['/bin/sh', '-c', command or 'true'],
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+counts = {{'sent': 0, 'received': 0}}
+
+
+def pump(source, target, key):
+    while True:
+        data = os.read(source, 65536)
+        if not data:
+            break
+        counts[key] += len(data)
+        os.write(target, data)
+
+
+def pump_stdin():
+    try:
+        pump(0, process.stdin.fileno(), 'sent')
+        process.stdin.close()
+    except (IOError, OSError):
+        pass
+
+
+thread = threading.Thread(target=pump_stdin)
+thread.daemon = True
+thread.start()
+pump(process.stdout.fileno(), 1, 'received')
+returncode = process.wait()
+
+with open({log!r}, 'a') as log:
+    log.write('{{0:d}} {{1:d}}\\n'.format(counts['sent'], counts['received']))
+sys.exit(returncode)
+'''
+
+BUILDOUT_CFG = '''[buildout]
+parts =
+'''
+
+IO_COUNTERS = ('rchar', 'wchar', 'syscr', 'syscw', 'read_bytes',
+               'write_bytes')
+
+
+class Hostout(object):
+    """Minimal stand-in for the hostout of the benchmarked site.
+    """
+
+    def __init__(self, name, options):
+        self.name = name
+        self.options = options
+        self.hostouts = {name: self}
+        self.extends = ['hostout.pushdeploy']
+
+
+def write_file(path, size, rnd):
+    """Write a file of the given size with half compressible content.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'wb') as output:
+        while size > 0:
+            chunk = min(size, 65536)
+            half = chunk // 2
+            output.write(os.urandom(half))
+            output.write(bytearray([rnd.randint(97, 102)]) * (chunk - half))
+            size -= chunk
+
+
+def create_egg(eggs_directory, name, rnd):
+    """Create a synthetic egg with a few modules.
+    """
+    egg_directory = os.path.join(eggs_directory,
+                                 '{0:s}-1.0-py2.7.egg'.format(name))
+    for i in range(rnd.randint(5, 20)):
+        write_file(os.path.join(egg_directory, name, 'module{0:d}.py'.format(
+            i)), rnd.randint(1024, 16384), rnd)
+    write_file(os.path.join(egg_directory, 'EGG-INFO', 'PKG-INFO'), 512, rnd)
+
+
+def write_installed(buildout_directory, parts, round_=0):
+    """Write .installed.cfg for the given part names (with the signature of
+    the first part changed for every round).
+
+    """
+    lines = ['[buildout]', 'installed_develop_eggs = ',
+             'parts = {0:s}'.format(' '.join(parts)), '']
+    for name in parts:
+        lines.extend([
+            '[{0:s}]'.format(name),
+            '__buildout_installed__ = {0:s}\n\t{1:s}'.format(
+                os.path.join(buildout_directory, 'parts', name),
+                os.path.join(buildout_directory, 'bin', name)),
+            '__buildout_signature__ = {0:s}-{1:d}'.format(
+                name, name == parts[0] and round_ or 0), ''])
+    with open(os.path.join(buildout_directory, '.installed.cfg'), 'w') as cfg:
+        cfg.write('\n'.join(lines))
+
+
+def create_buildout(buildout_directory, args, rnd):
+    """Create the local synthetic buildout (without data).
+    """
+    os.makedirs(buildout_directory)
+    with open(os.path.join(buildout_directory, 'buildout.cfg'), 'w') as cfg:
+        cfg.write(BUILDOUT_CFG)
+
+    for i in range(args.eggs):
+        create_egg(os.path.join(buildout_directory, 'eggs'),
+                   'egg{0:d}'.format(i), rnd)
+
+    parts = ['part{0:d}'.format(i) for i in range(args.parts)]
+    for name in parts:
+        for i in range(rnd.randint(1, 10)):
+            write_file(os.path.join(buildout_directory, 'parts', name,
+                                    'file{0:d}.txt'.format(i)),
+                       rnd.randint(1024, 65536), rnd)
+        script = os.path.join(buildout_directory, 'bin', name)
+        write_file(script, 1024, rnd)
+        os.chmod(script, stat.S_IRWXU)
+    write_installed(buildout_directory, parts)
+    os.makedirs(os.path.join(buildout_directory, 'var'))
+
+
+def create_data(var_directory, args, rnd):
+    """Create the synthetic Data.fs and blobstorage (of the remote site).
+    """
+    write_file(os.path.join(var_directory, 'filestorage', 'Data.fs'),
+               args.datafs_size * 1024 * 1024, rnd)
+    add_blobs(var_directory, 0, args.blobs, rnd)
+
+
+def add_blobs(var_directory, start, count, rnd):
+    """Add the given count of small blobs into bushy blobstorage.
+    """
+    blobstorage_directory = os.path.join(var_directory, 'blobstorage')
+    for oid in range(start, start + count):
+        path = [blobstorage_directory] + ['0x00'] * 6 + [
+            '0x{0:02x}'.format(oid >> 8 & 0xff),
+            '0x{0:02x}'.format(oid & 0xff),
+            '0x{0:016x}.blob'.format(oid)]
+        write_file(os.path.join(*path), rnd.randint(512, 32768), rnd)
+
+
+def change_buildout(buildout_directory, round_, rnd):
+    """Make a typical small change into the local buildout: a new egg and
+    a changed part.
+
+    """
+    create_egg(os.path.join(buildout_directory, 'eggs'),
+               'new{0:d}'.format(round_), rnd)
+    write_file(os.path.join(buildout_directory, 'parts', 'part0',
+                            'file0.txt'), rnd.randint(1024, 65536), rnd)
+    parts = sorted(os.listdir(os.path.join(buildout_directory, 'parts')),
+                   key=lambda name: int(name[len('part'):]))
+    write_installed(buildout_directory, parts, round_)
+
+
+def change_data(var_directory, round_, args, rnd):
+    """Make a typical change into the remote data: append into Data.fs and
+    add a few blobs.
+
+    """
+    datafs_path = os.path.join(var_directory, 'filestorage', 'Data.fs')
+    with open(datafs_path, 'ab') as datafs:
+        datafs.write(os.urandom(1024 * 1024))
+    add_blobs(var_directory, args.blobs + round_ * 10, 10, rnd)
+
+
+def io_counters():
+    """Return the I/O counters of this process (including the reaped
+    children) and the CPU time of the reaped children.
+
+    """
+    counters = dict([(key, 0) for key in IO_COUNTERS])
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                key, value = line.split(':', 1)
+                if key in counters:
+                    counters[key] = int(value)
+    except IOError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    counters['cpu'] = usage.ru_utime + usage.ru_stime
+    return counters
+
+
+def wire_bytes(log_path):
+    """Return the total bytes sent and received through the fake ssh.
+    """
+    sent = received = 0
+    if os.path.exists(log_path):
+        with open(log_path) as log:
+            for line in log:
+                values = line.split()
+                sent += int(values[0])
+                received += int(values[1])
+    return sent, received
+
+
+def measure(command, log_path):
+    """Run the given pushdeploy command and return its measurements.
+    """
+    before_io = io_counters()
+    before_wire = wire_bytes(log_path)
+    started = time.time()
+    failed = False
+    try:
+        with hide('running', 'stdout', 'stderr', 'warnings'):
+            getattr(fabfile, command)()
+    except (Exception, SystemExit) as e:
+        failed = True
+        print('{0:s} failed: {1:s}'.format(command, str(e)))
+    result = {'wall': time.time() - started, 'failed': failed}
+    after_wire = wire_bytes(log_path)
+    result['sent'] = after_wire[0] - before_wire[0]
+    result['received'] = after_wire[1] - before_wire[1]
+    after_io = io_counters()
+    for key in after_io:
+        result[key] = after_io[key] - before_io[key]
+    return result
+
+
+def run(args):
+    """Run the benchmark in the given workspace and return the results.
+    """
+    rnd = random.Random(args.seed)
+    workspace = os.path.abspath(args.workspace)
+    buildout_directory = os.path.join(workspace, 'buildout')
+    remote_root = os.path.join(workspace, 'remote')
+    remote_directory = remote_root + buildout_directory
+    log_path = os.path.join(workspace, 'wire.log')
+    user = getpass.getuser()
+
+    # Fake ssh
+    ssh_path = os.path.join(workspace, 'ssh')
+    with open(ssh_path, 'w') as ssh:
+        ssh.write(FAKE_SSH.format(
+            executable=sys.executable, path=buildout_directory,
+            remote_path=remote_directory, log=log_path))
+    os.chmod(ssh_path, stat.S_IRWXU)
+
+    # Site
+    options = {
+        'path': buildout_directory,
+        'buildout': 'buildout.cfg',
+        'buildout-user': user,
+        'effective-user': user,
+        'state-directory': os.path.join(workspace, 'state'),
+        'ssh-command': ssh_path,
+        'restart': 'true',
+        'local-sudo': 'false',
+        'remote-sudo': 'false',
+        'compression': 'auto',
+    }
+    for option in args.option:
+        key, value = option.split('=', 1)
+        options[key.strip()] = value.strip()
+    env.hostout = Hostout('benchmark', options)
+    env.host_string = '{0:s}@localhost:22'.format(user)
+    env.user = user
+
+    create_buildout(buildout_directory, args, rnd)
+
+    results = []
+    for command in args.commands.split(','):
+        for scenario in ('cold', 'warm', 'no-change'):
+            if scenario == 'cold':
+                if os.path.exists(remote_root):
+                    shutil.rmtree(remote_root)
+                for name in ('filestorage', 'blobstorage'):
+                    path = os.path.join(buildout_directory, 'var', name)
+                    if os.path.exists(path):
+                        shutil.rmtree(path)
+                os.makedirs(remote_directory)
+                create_data(os.path.join(remote_directory, 'var'), args, rnd)
+            elif scenario == 'warm':
+                if command == 'pull':
+                    change_data(os.path.join(remote_directory, 'var'),
+                                len(results), args, rnd)
+                else:
+                    change_buildout(buildout_directory, len(results) + 1,
+                                    rnd)
+            result = measure(command, log_path)
+            result.update({'command': command, 'scenario': scenario})
+            results.append(result)
+    return results
+
+
+def report(results):
+    """Print the results as a table.
+    """
+    columns = [('command', 8, '{0:<8s}'), ('scenario', 10, '{0:<10s}'),
+               ('wall', 8, '{0:>8.2f}'), ('sent', 12, '{0:>12d}'),
+               ('received', 12, '{0:>12d}'), ('cpu', 8, '{0:>8.2f}'),
+               ('syscr', 10, '{0:>10d}'), ('syscw', 10, '{0:>10d}'),
+               ('rchar', 12, '{0:>12d}'), ('wchar', 12, '{0:>12d}')]
+    print(' '.join([name.ljust(width) for name, width, fmt in columns]))
+    for result in results:
+        print(' '.join([fmt.format(result[name])
+                        for name, width, fmt in columns]) +
+              (result['failed'] and ' FAILED' or ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark pushdeploy push, pull and deploy against a '
+                    'local stand-in for the remote site.')
+    parser.add_argument('--eggs', type=int, default=100,
+                        help='number of synthetic eggs (default: 100)')
+    parser.add_argument('--parts', type=int, default=20,
+                        help='number of synthetic parts (default: 20)')
+    parser.add_argument('--datafs-size', type=int, default=64,
+                        help='size of Data.fs in megabytes (default: 64)')
+    parser.add_argument('--blobs', type=int, default=1000,
+                        help='number of blobs (default: 1000)')
+    parser.add_argument('--commands', default='push,pull,deploy',
+                        help='comma separated list of the commands to '
+                             'benchmark (default: push,pull,deploy)')
+    parser.add_argument('--option', action='append', default=[],
+                        help='hostout option as key=value (e.g. '
+                             'egg-manifest=true), could be repeated')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the synthetic content')
+    parser.add_argument('--workspace',
+                        help='directory for the benchmark (default: a new '
+                             'temporary directory, which is removed)')
+    parser.add_argument('--json', help='write the results as JSON into file')
+    args = parser.parse_args(argv)
+
+    temporary = not args.workspace
+    if temporary:
+        args.workspace = tempfile.mkdtemp(prefix='pushdeploy-benchmark-')
+    try:
+        results = run(args)
+    finally:
+        if temporary:
+            shutil.rmtree(args.workspace, ignore_errors=True)
+
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return any([result['failed'] for result in results]) and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
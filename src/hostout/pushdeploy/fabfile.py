@@ -2,38 +2,674 @@
 """Fabfile for hostout.pushdeploy to describe all the magic
 """
 
+import contextlib
+import fcntl
+import functools
+import hashlib
+import io
+import json
 import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import zc.buildout.buildout
 
+try:
+    import Queue as _queue
+except ImportError:
+    import queue as _queue
+
+try:
+    from shlex import quote as _quote
+except ImportError:
+    from pipes import quote as _quote
+
+try:
+    from ConfigParser import RawConfigParser as _RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser as _RawConfigParser
+
 from fabric.state import (
     env as _env,
     output as _output
 )
 
 from fabric.network import (
+    disconnect_all as _disconnect_all,
     normalize as _normalize,
     key_filenames as _key_filenames
 )
 
 from fabric.operations import (
-    run as _run,
-    sudo as _sudo,
-    local as _local
+    run as _fabric_run,
+    sudo as _fabric_sudo,
+    local as _fabric_local
 )
 
 from fabric.context_managers import (
+    hide as _hide,
     lcd as _lcd,
     settings as _settings
 )
 
+from fabric.utils import (
+    abort as _abort
+)
+
+
+def _instrumented(kind, func, command, *args, **kwargs):
+    """Call the given Fabric operation and record its wall-clock timing into
+    the report of the current command (when reporting is enabled).
+
+    """
+    report = _env.get('pushdeploy_report')
+    if report is None:
+        return func(command, *args, **kwargs)
+
+    record = {'type': kind, 'command': command, 'failed': True,
+              'phase': _current_phase()}
+    started = time.time()
+    try:
+        res = func(command, *args, **kwargs)
+        record['failed'] = bool(getattr(res, 'failed', False))
+        return res
+    finally:
+        record['duration'] = time.time() - started
+        report['invocations'].append(record)
+
+
+def _run(command, *args, **kwargs):
+    """Run the command on the remote site (instrumented Fabric run).
+    """
+    return _instrumented('run', _fabric_run, command, *args, **kwargs)
+
+
+def _sudo(command, *args, **kwargs):
+    """Run the command on the remote site with sudo (instrumented Fabric
+    sudo).
+    """
+    return _instrumented('sudo', _fabric_sudo, command, *args, **kwargs)
+
+
+def _local(command, *args, **kwargs):
+    """Run the command on the local site (instrumented Fabric local).
+    """
+    return _instrumented('local', _fabric_local, command, *args, **kwargs)
+
+
+# The current phase of the current command (per thread)
+_PHASE = threading.local()
+
+
+def _current_phase():
+    """Return the name of the current phase of the current thread.
+    """
+    return getattr(_PHASE, 'name', None)
+
+
+@contextlib.contextmanager
+def _phase(name):
+    """Record the wall-clock timing of the named phase of the current command
+    into its report (when reporting is enabled).
+
+    """
+    report = _env.get('pushdeploy_report')
+    parent = _current_phase()
+    phase = parent and '{0:s}/{1:s}'.format(parent, name) or name
+    record = {'name': phase, 'failed': True}
+    started = time.time()
+    _PHASE.name = phase
+    try:
+        yield
+        record['failed'] = False
+    finally:
+        _PHASE.name = parent
+        record['duration'] = time.time() - started
+        if report is not None:
+            report['phases'].append(record)
+
+
+def _open_report(command):
+    """Start collecting the report of the given command, when ``report``
+    -hostout-option is set.
+
+    """
+    if _env.hostout.options.get('report') != 'true':
+        return
+    _env['pushdeploy_report'] = {
+        'command': command,
+        'hostout': _env.hostout.name,
+        'host': _env.host_string,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'phases': [],
+        'invocations': []
+    }
+    _env['pushdeploy_report_started'] = time.time()
+
+
+def _close_report(failed):
+    """Write the report of the current command as JSON into the directory
+    set with ``report-directory`` -hostout-option (defaults to ``reports``
+    in the state directory).
+
+    """
+    report = _env.get('pushdeploy_report')
+    if report is None:
+        return
+    _env['pushdeploy_report'] = None
+
+    report['failed'] = failed
+    report['duration'] = time.time() - _env['pushdeploy_report_started']
+
+    report_directory = _env.hostout.options.get('report-directory') or \
+        _state_path('reports')
+    if not os.path.isdir(report_directory):
+        os.makedirs(report_directory)
+    path = os.path.join(report_directory, '{0:s}-{1:s}.json'.format(
+        time.strftime('%Y%m%d%H%M%S'), report['command']))
+    with open(path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+    if _output.running:
+        print('[localhost] report: {0:s}'.format(path))
+
+
+def _rsync_stats(output):
+    """Parse the output of rsync --stats into a dict.
+    """
+    patterns = {
+        'files': r'Number of files: ([\d,]+)',
+        'files_transferred': r'Number of (?:regular )?files transferred: '
+                             r'([\d,]+)',
+        'total_size': r'Total file size: ([\d,]+)',
+        'transferred_size': r'Total transferred file size: ([\d,]+)',
+        'literal_bytes': r'Literal data: ([\d,]+)',
+        'matched_bytes': r'Matched data: ([\d,]+)',
+        'bytes_sent': r'Total bytes sent: ([\d,]+)',
+        'bytes_received': r'Total bytes received: ([\d,]+)',
+        'speedup': r'speedup is ([\d,.]+)'
+    }
+    stats = {}
+    for key, pattern in patterns.items():
+        match = re.search(pattern, output)
+        if match:
+            value = match.group(1).replace(',', '')
+            stats[key] = float(value) if key == 'speedup' else int(value)
+    return stats
+
+
+@contextlib.contextmanager
+def _resource_lock(name):
+    """Hold an exclusive lock on the named local resource (e.g. ``var``),
+    which is shared between threads and processes of the selected hostout.
+
+    """
+    with open(_state_path('{0:s}.lock'.format(name)), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _schedule(tasks):
+    """Run the given tasks concurrently, each one in its own thread as soon
+    as all the tasks it requires have succeeded. Tasks are dicts with
+    ``name``, ``func`` and a list of the names of the ``requires`` -tasks.
+
+    """
+    parent = _current_phase()
+    condition = threading.Condition()
+    started = set()
+    succeeded = set()
+    failed = set()
+
+    def runner(task):
+        _PHASE.name = parent
+        success = False
+        try:
+            with _phase(task['name']):
+                task['func']()
+            success = True
+        except BaseException as e:
+            print('[localhost] {0:s} failed: {1:s}'.format(task['name'],
+                                                          str(e)))
+        finally:
+            with condition:
+                (success and succeeded or failed).add(task['name'])
+                condition.notify_all()
+
+    threads = []
+    with condition:
+        while len(succeeded) + len(failed) < len(tasks):
+            for task in tasks:
+                if task['name'] in started:
+                    continue
+                if any([name in failed for name in task['requires']]):
+                    started.add(task['name'])
+                    failed.add(task['name'])
+                elif all([name in succeeded for name in task['requires']]):
+                    started.add(task['name'])
+                    thread = threading.Thread(target=runner, args=(task,))
+                    thread.start()
+                    threads.append(thread)
+            if len(succeeded) + len(failed) < len(tasks):
+                condition.wait()
+
+    for thread in threads:
+        thread.join()
+
+    if failed:
+        _abort(u'Failed: {0:s}'.format(' '.join(
+            [task['name'] for task in tasks if task['name'] in failed])))
+
+
+# Serializes the prefixed output of the parallel hostout processes
+_OUTPUT_LOCK = threading.Lock()
+
+
+def _run_hostout(section, command, *args):
+    """Run the given hostout command for the given hostout section in a
+    separate process with its output prefixed with the section name.
+    Returns the exit code of the process.
+
+    """
+    hostout_script = os.path.abspath(sys.argv[0])
+    cmd = [sys.executable, hostout_script, section, command] + list(args)
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   universal_newlines=True)
+        for line in iter(process.stdout.readline, ''):
+            with _OUTPUT_LOCK:
+                sys.stdout.write('[{0:s}] {1:s}'.format(section, line))
+                sys.stdout.flush()
+        return process.wait()
+    except OSError as e:
+        with _OUTPUT_LOCK:
+            print('[{0:s}] {1:s}'.format(section, str(e)))
+        return -1
+
+
+def _remote_host():
+    """Return user, host and port of the current remote site.
+    """
+    user, host, port = _normalize(_env.host_string)
+    if host.startswith('@'):
+        host = host[1:]
+    return user, host, port
+
+
+def _ssh_command(ssh_opts='', shared=True):
+    """Return the ssh command (honoring SSH keys, port and the shared master
+    connection unless ``shared`` is false) for connecting the current remote
+    site.
+
+    """
+    # Honor SSH key(s)
+    key_string = ''
+    keys = _key_filenames()
+    if keys:
+        key_string = '-i ' + ' -i '.join(keys)
+
+    # Port
+    user, host, port = _remote_host()
+    port_string = '-p {0:s}'.format(port)
+
+    # Shared connection
+    control_string = ''
+    control_path = _env.get('pushdeploy_control_path')
+    if control_path and shared:
+        control_string = '-o ControlPath={0:s}'.format(control_path)
+
+    # Command (e.g. a wrapper script)
+    ssh_string = _env.hostout.options.get('ssh-command') or 'ssh'
+
+    ssh_parts = [ssh_string, key_string, port_string, control_string,
+                 ssh_opts]
+    return ' '.join(filter(bool, ssh_parts))
+
+
+def _open_connection():
+    """Start a shared SSH master connection for the current remote site,
+    when ``ssh-multiplex`` -hostout-option is set.
+
+    """
+    if _env.hostout.options.get('ssh-multiplex') != 'true':
+        return
+    if not _env.host_string:
+        return
+
+    control_directory = tempfile.mkdtemp(prefix='pushdeploy-')
+    control_path = os.path.join(control_directory, '%r@%h:%p')
+
+    user, host, port = _remote_host()
+    cmd = ('{0:s} -o ControlMaster=yes -o ControlPersist=yes '
+           '-o ControlPath={1:s} -f -N {2:s}@{3:s}').format(
+        _ssh_command(), control_path, user, host)
+    if _output.running:
+        print('[localhost] connect: {0:s}'.format(cmd))
+    _local(cmd)
+
+    _env['pushdeploy_control_path'] = control_path
+    _env['pushdeploy_control_directory'] = control_directory
+
+
+def _close_connection():
+    """Tear down the shared SSH master connection (if any) and all Fabric
+    connections of the current task.
+
+    """
+    control_path = _env.get('pushdeploy_control_path')
+    control_directory = _env.get('pushdeploy_control_directory')
+
+    if control_path:
+        user, host, port = _remote_host()
+        cmd = '{0:s} -O exit {1:s}@{2:s}'.format(_ssh_command(), user, host)
+        if _output.running:
+            print('[localhost] disconnect: {0:s}'.format(cmd))
+        with _settings(_hide('everything'), warn_only=True):
+            _local(cmd)
+        _env['pushdeploy_control_path'] = None
+        _disconnect_all()
+
+    if control_directory:
+        shutil.rmtree(control_directory, ignore_errors=True)
+        _env['pushdeploy_control_directory'] = None
+
+
+def _task(func):
+    """Run the decorated command within a per-host task context, which
+    shares a single SSH connection between all the rsync and remote commands
+    run during the command (including the nested commands) and collects
+    the timing report of the command.
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = _env.get('pushdeploy_depth', 0)
+        if depth == 0:
+            _open_report(func.__name__)
+            _open_connection()
+        _env['pushdeploy_depth'] = depth + 1
+        failed = True
+        try:
+            with _phase(func.__name__):
+                res = func(*args, **kwargs)
+            failed = False
+            return res
+        finally:
+            _env['pushdeploy_depth'] = depth
+            if depth == 0:
+                _close_connection()
+                _close_report(failed)
+    return wrapper
+
+
+def _remote(cmd, sudo=None):
+    """Run the given command on the remote site either with or without sudo
+    (defaults to ``remote-sudo`` -hostout-option). Uses the shared SSH
+    connection when available and the ``ssh-command`` -hostout-option when
+    set.
+
+    """
+    if sudo is None:
+        sudo = _env.hostout.options.get('remote-sudo') == 'true'
+
+    if not _env.get('pushdeploy_control_path') \
+            and not _env.hostout.options.get('ssh-command'):
+        if sudo:
+            return _sudo(cmd)
+        else:
+            return _run(cmd)
+
+    user, host, port = _remote_host()
+    if sudo:
+        cmd = 'sudo -n /bin/sh -c {0:s}'.format(_quote(cmd))
+    if _output.running:
+        print('[{0:s}] {1:s}: {2:s}'.format(host, sudo and 'sudo' or 'run',
+                                            cmd))
+    res = _local('{0:s} {1:s}@{2:s} {3:s}'.format(
+        _ssh_command(), user, host, _quote(cmd)), capture=True)
+    if _output.stdout and res:
+        print(res)
+    return res
+
+
+# Maximum size of a single remote (or local) command (well below the 128 KiB
+# limit of a single argument, e.g. a script given to sh -c)
+_COMMAND_SIZE = 32 * 1024
+
+# Prefix for the rsync output lines reporting the changed files
+_CHANGED_MARKER = 'pushdeploy-changed: '
+
+
+def _chown_changed(directory, paths, user, remote=False):
+    """Chown only the given (changed) paths below the given directory either
+    on the local or on the remote site.
+
+    """
+    local_sudo = _env.hostout.options.get('local-sudo') == 'true'
+
+    # Chunk the paths to keep every command well below the argument limit
+    chunks = [[]]
+    size = 0
+    for path in paths:
+        quoted = _quote(os.path.join(directory, path))
+        if chunks[-1] and size + len(quoted) > _COMMAND_SIZE:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(quoted)
+        size += len(quoted) + 1
+
+    cmds = []
+    for chunk in filter(bool, chunks):
+        cmd = 'chown -h {0:s} -- {1:s}'.format(user, ' '.join(chunk))
+        if remote:
+            cmds.append(cmd)
+        else:
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] chown: {0:s}'.format(cmd))
+            _local(cmd)
+    _remote_batch(cmds)
+
+
+def _chown_var(var_directory, user):
+    """Chown the local var-directory for the given user without walking
+    (or touching) the contents of filestorage and blobstorage and without
+    touching the files already owned by the user.
+
+    """
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+    cmd = ("find {0:s} \\( -path '{0:s}/filestorage/*' "
+           "-o -path '{0:s}/blobstorage/*' \\) -prune "
+           "-o ! -user {1:s} -exec chown -h {1:s} {{}} +").format(
+        var_directory, user)
+    if local_sudo:
+        cmd = 'sudo {0:s}'.format(cmd)
+    if _output.running:
+        print('[localhost] chown: {0:s}'.format(cmd))
+    _local(cmd)
+
+
+# Prefix for the output lines reporting the exit statuses of batched commands
+_STATUS_MARKER = 'pushdeploy-status:'
+
+
+def _remote_batch(cmds, sudo=None):
+    """Run the given commands on the remote site as a single script (with a
+    single sudo elevation), which is split into several scripts only to keep
+    each of them below the argument limit. The scripts stop at the first
+    failing command, which is then reported with its output (and aborts
+    unless ``warn_only`` is set). Returns a list of (command, exit status,
+    output) -tuples for the executed commands.
+
+    """
+    cmds = [cmd for cmd in cmds if cmd]
+    if not cmds:
+        return []
+
+    scripts = [[]]
+    size = 0
+    for i, cmd in enumerate(cmds):
+        line = ('( {0:s}\n); status=$?; echo "{1:s}{2:d}:$status"; '
+                '[ $status -eq 0 ] || exit $status'.format(
+                    cmd, _STATUS_MARKER, i))
+        if scripts[-1] and size + len(line) > _COMMAND_SIZE:
+            scripts.append([])
+            size = 0
+        scripts[-1].append(line)
+        size += len(line) + 1
+
+    results = []
+    for script in scripts:
+        with _settings(warn_only=True):
+            res = _remote('\n'.join(script), sudo=sudo)
+
+        lines = []
+        executed = len(results)
+        for line in res.splitlines():
+            if line.startswith(_STATUS_MARKER):
+                i, status = line[len(_STATUS_MARKER):].split(':', 1)
+                results.append((cmds[int(i)], int(status), '\n'.join(lines)))
+                lines = []
+            else:
+                lines.append(line)
+
+        if not res.failed:
+            continue
+
+        if len(results) > executed and results[-1][1] != 0:
+            cmd, status, output = results[-1]
+        else:
+            cmd, status, output = cmds[len(results)], res.return_code, \
+                '\n'.join(lines)
+        message = u'Remote command failed with exit status {0:d}: {1:s}'\
+            .format(status, cmd)
+        if output.strip():
+            message += u'\n{0:s}'.format(output.strip())
+        if _env.warn_only:
+            print('Warning: {0:s}'.format(message))
+        else:
+            _abort(message)
+        break
+
+    return results
+
+
+# Suffixes of the already compressed files (not worth compressing again)
+_SKIP_COMPRESS = ('7z/ace/apk/avi/bz2/deb/docx/egg/flac/gif/gpg/gz/iso/jar/'
+                  'jpeg/jpg/lz/lz4/lzma/lzo/m4a/mkv/mov/mp3/mp4/odp/ods/odt/'
+                  'ogg/pdf/png/pptx/rar/rpm/tbz/tgz/webm/webp/whl/xlsx/xz/z/'
+                  'zip/zst')
+
+# The version of the local rsync (cached)
+_RSYNC_VERSION = {}
+
+
+def _rsync_version():
+    """Return the version of the local rsync as a tuple of integers.
+    """
+    if 'version' not in _RSYNC_VERSION:
+        try:
+            output = subprocess.Popen(
+                ['rsync', '--version'], stdout=subprocess.PIPE,
+                universal_newlines=True).communicate()[0]
+        except OSError:
+            output = ''
+        match = re.search(r'version (\d+)\.(\d+)\.(\d+)', output)
+        _RSYNC_VERSION['version'] = match and tuple(
+            [int(part) for part in match.groups()]) or (0, 0, 0)
+    return _RSYNC_VERSION['version']
+
+
+def _link_speed():
+    """Return the throughput (bytes per second) of the link to the current
+    remote site. The link is probed by timing the transfer of incompressible
+    data (minus the time of an empty command) and the result is cached in
+    the state directory for an hour. Returns None when the probe fails.
+
+    """
+    state = _load_state('link', {})
+    if state.get('host') == _env.host_string \
+            and time.time() - state.get('probed', 0) < 3600:
+        return state['speed']
+
+    size = 4 * 1024 * 1024
+    user, host, port = _remote_host()
+    ssh = '{0:s} {1:s}@{2:s}'.format(_ssh_command(), user, host)
+    # Probe with the same ssh (and local sudo) as rsync does
+    if _env.hostout.options.get('local-sudo') == 'true':
+        ssh = 'sudo {0:s}'.format(ssh)
+    timings = []
+    probe = '{0:s} "head -c {1:d} /dev/urandom" | wc -c'.format(ssh, size)
+    for cmd in ['{0:s} true'.format(ssh), probe]:
+        if _output.running:
+            print('[localhost] probe: {0:s}'.format(cmd))
+        started = time.time()
+        with _settings(_hide('stdout', 'warnings'), warn_only=True):
+            res = _local(cmd, capture=True)
+        timings.append(time.time() - started)
+        # wc exits successfully even when ssh fails
+        if res.failed or cmd == probe and res.strip() != str(size):
+            print('Warning: probing the link failed, compressing')
+            return None
+
+    speed = size / max(timings[1] - timings[0], 0.001)
+    _save_state('link', {'host': _env.host_string, 'probed': time.time(),
+                         'speed': speed})
+    return speed
+
+
+def _compress_opts(compress=True):
+    """Return the rsync compression options for a transfer. Compression is
+    enabled with ``compression`` -hostout-option (``true``, ``false`` or
+    ``auto`` (default), which compresses only when the probed link is slower
+    than ``compression-threshold`` megabytes per second (default: 10)).
+
+    """
+    mode = _env.hostout.options.get('compression') or 'auto'
+    if not compress or mode in ('false', 'False', 'no', 'off', '0'):
+        return ''
+    if mode == 'auto':
+        threshold = float(
+            _env.hostout.options.get('compression-threshold') or 10)
+        speed = _link_speed()
+        if speed is not None and speed >= threshold * 1024 * 1024:
+            return ''
+
+    opts = ['-z', '--skip-compress={0:s}'.format(
+        _env.hostout.options.get('skip-compress') or _SKIP_COMPRESS)]
+    choice = _env.hostout.options.get('compress-choice')
+    if choice and _rsync_version() >= (3, 2, 0):
+        opts.append('--compress-choice={0:s}'.format(choice))
+    level = _env.hostout.options.get('compress-level')
+    if level:
+        opts.append('--compress-level={0:s}'.format(level))
+    return ' '.join(opts)
+
 
 def _rsync(from_path, to_path, reverse=False,
            exclude=(), delete=False, extra_opts="",
-           ssh_opts="", capture=False):
+           ssh_opts="", capture=False, chown=None, chown_directory=None,
+           compress=True):
     """Perform rsync from some remote location to some local location.
     Optionally does exactly the reverse (syncs from some local location
     to some remote location)
 
+    When ``chown`` is given, the transferred files are chown for that user
+    either by rsync itself (when ``rsync-chown`` -hostout-option is set) or
+    by chowning only the files, which rsync reported as changed (below
+    ``chown_directory``, which defaults to the destination path).
+
+    When ``compress`` is false (e.g. for the already compressed blobs), the
+    transfer is never compressed.
+
     """
     # Adapted from:
     # https://github.com/fabric/fabric/blob/master/fabric/contrib/project.py
@@ -44,29 +680,39 @@ def _rsync(from_path, to_path, reverse=False,
     # Double-backslash-escape
     exclusions = tuple([str(s).replace('"', '\\\\"') for s in exclude])
 
-    # Honor SSH key(s)
-    key_string = ''
-    keys = _key_filenames()
-    if keys:
-        key_string = '-i ' + ' -i '.join(keys)
-
-    # Port
-    user, host, port = _normalize(_env.host_string)
-    if host.startswith('@'):
-        host = host[1:]
-    port_string = '-p {0:s}'.format(port)
+    # Host
+    user, host, port = _remote_host()
 
     # RSH
-    rsh_string = ''
-    rsh_parts = [key_string, port_string, ssh_opts]
-    if any(rsh_parts):
-        rsh_string = '--rsh="ssh {0:s}"'.format(' '.join(rsh_parts))
+    rsh_string = '--rsh="{0:s}"'.format(_ssh_command(ssh_opts))
 
     # Set remote sudo
     if _env.hostout.options.get('remote-sudo') == 'true':
         remote_sudo = ' --rsync-path="sudo rsync"'
         extra_opts = (extra_opts + remote_sudo).strip()
 
+    # Collect statistics
+    report = _env.get('pushdeploy_report')
+    if report is not None:
+        extra_opts = (extra_opts + ' --stats').strip()
+
+    # Set compression
+    extra_opts = (extra_opts + ' ' + _compress_opts(compress)).strip()
+
+    # Keep the partially transferred files of a deploy (for resuming)
+    if _env.get('pushdeploy_checkpoint') is not None:
+        extra_opts = (extra_opts + ' --partial-dir=.rsync-partial').strip()
+
+    # Set ownership
+    fixup = bool(chown) and \
+        _env.hostout.options.get('rsync-chown') != 'true'
+    if chown and not fixup:
+        extra_opts = (extra_opts + ' --owner --chown={0:s}'.format(
+            chown)).strip()
+    elif fixup:
+        extra_opts = (extra_opts + ' --out-format="{0:s}%i %n"'.format(
+            _CHANGED_MARKER)).strip()
+
     # Set up options part of string
     options_map = {
         'delete': '--delete' if delete else '',
@@ -75,7 +721,7 @@ def _rsync(from_path, to_path, reverse=False,
         'extra': extra_opts
     }
 
-    options = ('%(delete)s%(exclude)s -pthlrz '
+    options = ('%(delete)s%(exclude)s -pthlr '
                '%(extra)s %(rsh)s') % options_map
 
     # Interpret direction and define command
@@ -90,7 +736,34 @@ def _rsync(from_path, to_path, reverse=False,
         cmd = 'sudo {0:s}'.format(cmd)
     if _output.running:
         print('[localhost] rsync: {0:s}'.format(cmd))
-    return _local(cmd, capture=capture)
+    if not fixup and report is None:
+        return _local(cmd, capture=capture)
+
+    res = _instrumented('rsync', _fabric_local, cmd, capture=True)
+
+    # Record statistics
+    if report is not None:
+        for record in reversed(report['invocations']):
+            if record['command'] == cmd:
+                record['stats'] = _rsync_stats(res)
+                break
+
+    # Chown the changed files
+    changed = []
+    lines = []
+    for line in res.splitlines():
+        if line.startswith(_CHANGED_MARKER):
+            item, path = line[len(_CHANGED_MARKER):].split(' ', 1)
+            if not item.startswith('*'):  # e.g. '*deleting'
+                changed.append(path)
+        else:
+            lines.append(line)
+    if not capture and _output.stdout and lines:
+        print('\n'.join(lines))
+    if fixup and changed and not res.failed:
+        _chown_changed(chown_directory or (reverse and from_path or to_path),
+                       changed, chown, remote=reverse)
+    return res
 
 
 def clone(repository, branch=None):
@@ -169,27 +842,89 @@ def bootstrap():
         _env.hostout.options.get('bootstrap-python') or buildout_python
     )
 
+    # Start with the variant, which succeeded the last time
+    variants = [' --distribute', '']
+    state = _load_state('stage', {})
+    if state.get('bootstrap') in variants:
+        variants.remove(state['bootstrap'])
+        variants.insert(0, state['bootstrap'])
+
     # Bootstrap
     with _lcd(buildout_directory):
-        cmd = '{0:s} bootstrap.py --distribute'.format(bootstrap_python)
-        cmd = 'su {0:s} -c "{1:s}"'.format(buildout_user, cmd)
-        if local_sudo:
-            cmd = 'sudo {0:s}'.format(cmd)
-        if _output.running:
-            print('[localhost] bootstrap: %s' % cmd)
+        for variant in variants:
+            cmd = '{0:s} bootstrap.py{1:s}'.format(bootstrap_python, variant)
+            cmd = 'su {0:s} -c "{1:s}"'.format(buildout_user, cmd)
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] bootstrap: %s' % cmd)
+
+            with _settings(warn_only=variant != variants[-1]):
+                res = _local(cmd)
+            if not res.failed:
+                break
+            print('Bootstrap failed: we have a new bootstrap which '
+                  'has --distribute option now default (or the other way '
+                  'around). Trying again...')
+
+    state = _load_state('stage', {})
+    state['bootstrap'] = variant
+    _save_state('stage', state)
+
+
+def _buildout_config_files(path, seen=None):
+    """Return the list of buildout configuration files read for the given
+    configuration file (the file itself and its extends chain).
+
+    """
+    seen = seen if seen is not None else set()
+    if path in seen:
+        return []
+    seen.add(path)
+
+    files = [path]
+    if '://' in path or not os.path.exists(path):
+        return files
+
+    values = []
+    section = None
+    collecting = False
+    with open(path) as config:
+        for line in config:
+            if line[:1] in ('#', ';'):
+                continue
+            if line.startswith('['):
+                section = line.strip()
+                collecting = False
+            elif collecting and line[:1] in (' ', '\t'):
+                values.append(line.strip())
+            else:
+                match = re.match(r'extends\s*[+-]?=(.*)', line)
+                collecting = bool(match) and section == '[buildout]'
+                if collecting:
+                    values.append(match.group(1).strip())
+
+    for value in ' '.join(values).split():
+        if '://' not in value:
+            value = os.path.join(os.path.dirname(path), value)
+        files.extend(_buildout_config_files(value, seen))
+    return files
+
+
+def _annotations_key(config_files):
+    """Return the cache key for the given buildout configuration files.
+    """
+    checksum = hashlib.sha1()
+    for path in config_files:
+        checksum.update(path.encode('utf-8'))
+        if os.path.isfile(path):
+            with open(path, 'rb') as config:
+                checksum.update(hashlib.sha1(config.read()).digest())
+    return checksum.hexdigest()
 
-        with _settings(warn_only=True):
-            res = _local(cmd)
-            if res.failed:
-                print('First bootstrap failed: we have a new bootstrap which '
-                      'has --distribute option now default. Trying again...')
-                cmd = '{0:s} bootstrap.py'.format(bootstrap_python)
-                cmd = 'su {0:s} -c "{1:s}"'.format(buildout_user, cmd)
-                if local_sudo:
-                    cmd = 'sudo {0:s}'.format(cmd)
-                if _output.running:
-                    print('[localhost] bootstrap: %s' % cmd)
-                _local(cmd)
+
+# In-process cache of the annotated buildout sections
+_ANNOTATIONS = {}
 
 
 def annotate():
@@ -202,20 +937,48 @@ def annotate():
 
     assert buildout_directory, u'No path found for the selected hostout'
 
+    return dict(_annotate_sections(buildout_directory,
+                                   buildout_user)['buildout'])
+
+
+def _annotate_sections(buildout_directory, buildout_user):
+    """Read buildout configuration and return its 'buildout' and 'versions'
+    sections (cached with the contents of all the read configuration files).
+
+    """
+    buildout_config = '{0:s}/{1:s}'.format(buildout_directory,
+                                           _env.hostout.options['buildout'])
+    buildout_home = os.path.expanduser('~{0:s}'.format(buildout_user))
+
+    # Look up the cache (keyed with the contents of all the read files)
+    config_files = _buildout_config_files(buildout_config) + [
+        os.path.join(buildout_home, '.buildout', 'default.cfg')]
+    key = _annotations_key(config_files)
+    if key in _ANNOTATIONS:
+        return _ANNOTATIONS[key]
+    cache = _load_state('annotations', {})
+    if key in cache:
+        _ANNOTATIONS[key] = cache[key]
+        return _ANNOTATIONS[key]
+
     my_home = os.environ.get('HOME')
     try:
-        os.environ['HOME'] = os.path.expanduser('~{0:s}'.format(buildout_user))
-        buildout = zc.buildout.buildout.Buildout(
-            '{0:s}/{1:s}'.format(buildout_directory,
-                                 _env.hostout.options['buildout']), []
-        )
-        return buildout.get('buildout')
+        os.environ['HOME'] = buildout_home
+        buildout = zc.buildout.buildout.Buildout(buildout_config, [])
+        annotations = dict(buildout.get('buildout'))
+        versions = dict(buildout.get(annotations.get('versions') or
+                                     'versions') or {})
     finally:
         if my_home is not None:
             os.environ['HOME'] = my_home
         else:
             del os.environ['HOME']
 
+    _ANNOTATIONS[key] = {'buildout': annotations, 'versions': versions,
+                         'key': key}
+    _save_state('annotations', {key: _ANNOTATIONS[key]})
+    return _ANNOTATIONS[key]
+
 
 def buildout(*args):
     """Execute the local buildout
@@ -236,12 +999,8 @@ def buildout(*args):
 
     # Chown var-directory
     var_directory = os.path.join(buildout_directory, 'var')
-    cmd = 'chown -R {0:s} {1:s}'.format(buildout_user, var_directory)
-    if local_sudo:
-        cmd = 'sudo {0:s}'.format(cmd)
-    if _output.running:
-        print('[localhost] pull: {0:s}'.format(cmd))
-    _local(cmd)
+    with _resource_lock('var'):
+        _chown_var(var_directory, buildout_user)
 
     # Buildout
     with _lcd(buildout_directory):
@@ -254,164 +1013,1553 @@ def buildout(*args):
         _local(cmd)
 
     # Chown var-directory
-    var_directory = os.path.join(buildout_directory, 'var')
-    cmd = 'chown -R {0:s} {1:s}'.format(effective_user, var_directory)
-    if local_sudo:
-        cmd = 'sudo {0:s}'.format(cmd)
-    if _output.running:
-        print('[localhost] pull: {0:s}'.format(cmd))
-    _local(cmd)
+    with _resource_lock('var'):
+        _chown_var(var_directory, effective_user)
 
 
-def pull():
-    """Pull the data from the remote site into the local buildout.
+def _state_path(name):
+    """Return path for the named local state file of the selected hostout.
+    The state directory defaults to ``~/.pushdeploy/<hostout>``, but could
+    be overridden by setting ``state-directory`` -hostout-option.
+
     """
+    state_directory = _env.hostout.options.get('state-directory') or \
+        os.path.join(os.path.expanduser('~'), '.pushdeploy',
+                     _env.hostout.name)
+    if not os.path.isdir(state_directory):
+        os.makedirs(state_directory)
+    return os.path.join(state_directory, name)
 
-    buildout_directory = _env.hostout.options.get('path')
-    fallback_user = _env.user or 'root'
-    effective_user = _env.hostout.options.get('effective-user', fallback_user)
-    local_sudo = _env.hostout.options.get('local-sudo') == "true"
 
-    assert buildout_directory, u'No path found for the selected hostout'
+def _load_state(name, default=None):
+    """Return the named local state of the selected hostout.
+    """
+    path = _state_path('{0:s}.json'.format(name))
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except ValueError:
+        return default
 
-    var_directory = os.path.join(buildout_directory, 'var')
-    filestorage_directory = os.path.join(var_directory, 'filestorage')
 
-    # Ensure filestorage
-    if not os.path.exists(var_directory):
-        cmd = 'mkdir -p {0:s}'.format(filestorage_directory)
-        if local_sudo:
-            cmd = 'sudo {0:s}'.format(cmd)
-        if _output.running:
-            print('[localhost] pull: {0:s}'.format(cmd))
-        _local(cmd)
+def _save_state(name, state):
+    """Save the named local state of the selected hostout.
+    """
+    path = _state_path('{0:s}.json'.format(name))
+    with open(path + '.tmp', 'w') as state_file:
+        json.dump(state, state_file, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
 
-    # Pull filestorage
-    _rsync(os.path.join(filestorage_directory, 'Data.fs'),
-           os.path.join(filestorage_directory, 'Data.fs'),
-           delete=True)
 
-    # Pull blobstorage
-    _rsync(os.path.join(var_directory, 'blobstorage'), var_directory,
-           delete=True)
+def _step_pending(name):
+    """Return False when the named step has already been completed by the
+    deploy being resumed (and True otherwise).
 
-    # Chown var-directory
-    var_directory = os.path.join(buildout_directory, 'var')
-    cmd = 'chown -R {0:s} {1:s}'.format(effective_user, var_directory)
-    if local_sudo:
-        cmd = 'sudo {0:s}'.format(cmd)
+    """
+    checkpoint = _env.get('pushdeploy_checkpoint')
+    if checkpoint is None or name not in checkpoint['steps']:
+        return True
     if _output.running:
-        print('[localhost] pull: {0:s}'.format(cmd))
-    _local(cmd)
+        print('[localhost] resume: skipping completed {0:s}'.format(name))
+    return False
+
 
+def _step_done(name):
+    """Record the named step as completed into the checkpoint of the current
+    deploy (in the state directory).
 
-def stage():
-    """Update the local staged buildout
     """
+    checkpoint = _env.get('pushdeploy_checkpoint')
+    if checkpoint is not None:
+        checkpoint['steps'].append(name)
+        _save_state('deploy', checkpoint)
 
-    # Pull
-    pull()
 
-    # Update
-    update()
+def _checkpoint_value(name, value):
+    """Return the named value of the deploy being resumed (or record the
+    given value into the checkpoint of the current deploy).
 
-    # Bootstrap
-    bootstrap()
+    """
+    checkpoint = _env.get('pushdeploy_checkpoint')
+    if checkpoint is None:
+        return value
+    if checkpoint.get(name) is None:
+        checkpoint[name] = value
+        _save_state('deploy', checkpoint)
+    return checkpoint[name]
 
-    # Buildout
-    buildout()
 
-    # Restart
-    if _env.hostout.options.get('local-restart') == "true":
-        local_sudo = _env.hostout.options.get('local-sudo') == "true"
-        cmds = filter(bool, _env.hostout.options.get('restart').split('\n'))
+# The size of the head and tail windows used to fingerprint a pulled prefix
+# of the append-only Data.fs
+_DATAFS_WINDOW = 1024 * 1024
 
-        assert cmds, u'No restart commands found for the selected hostout'
 
-        for cmd in cmds:
-            if local_sudo:
-                cmd = 'sudo {0:s}'.format(cmd)
-            if _output.running:
-                print('[localhost] restart: {0:s}'.format(cmd))
-            _local(cmd)
+def _datafs_fingerprint(path, size):
+    """Return fingerprint for the first size bytes of the local file at path.
+    """
+    checksum = hashlib.sha1()
+    with open(path, 'rb') as datafs:
+        checksum.update(datafs.read(min(size, _DATAFS_WINDOW)))
+        start = max(0, size - _DATAFS_WINDOW)
+        datafs.seek(start)
+        checksum.update(datafs.read(size - start))
+    return checksum.hexdigest()
 
 
-def push():
-    """Push the local buildout results (without data) to the remote site.
+def _remote_datafs_fingerprint(path, size):
+    """Return fingerprint for the first size bytes of the remote file at path.
     """
+    start = max(0, size - _DATAFS_WINDOW)
+    cmd = ('(head -c {0:d} {1:s}; tail -c +{2:d} {1:s} | head -c {3:d}) '
+           '| sha1sum').format(min(size, _DATAFS_WINDOW), path,
+                               start + 1, size - start)
+    with _hide('stdout'):
+        return _remote(cmd).split()[0]
 
-    # TODO: Currently all remote directories are chown for effective-user.
-    # We should remote this for everything else except var-directory
 
-    buildout_directory = _env.hostout.options.get('path')
+def _pull_datafs_incremental(datafs_path):
+    """Append only the new bytes of the remote append-only Data.fs to the
+    local copy. Returns False when the last pulled prefix has been changed
+    (e.g. the remote has been packed) and a full pull is required.
 
-    fallback_user = _env.user or 'root'
-    effective_user = _env.hostout.options.get('effective-user', fallback_user)
-    remote_sudo = _env.hostout.options.get('remote-sudo') == 'true'
+    """
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+    state = _load_state('datafs')
+
+    if not state or not os.path.exists(datafs_path):
+        return False
+    size = state['size']
+    if os.path.getsize(datafs_path) != size or \
+            _datafs_fingerprint(datafs_path, size) != state['fingerprint']:
+        return False
+
+    with _hide('stdout'):
+        remote_size = int(_remote('stat -c %s {0:s}'.format(datafs_path)))
+    if remote_size < size or _remote_datafs_fingerprint(
+            datafs_path, size) != state['fingerprint']:
+        return False
+
+    # Append the tail
+    if remote_size > size:
+        user, host, port = _remote_host()
+        cmd = 'tail -c +{0:d} {1:s} | head -c {2:d}'.format(
+            size + 1, datafs_path, remote_size - size)
+        if _env.hostout.options.get('remote-sudo') == 'true':
+            cmd = 'sudo -n /bin/sh -c {0:s}'.format(_quote(cmd))
+        cmd = '{0:s} {1:s}@{2:s} {3:s} >> {4:s}'.format(
+            _ssh_command(), user, host, _quote(cmd), datafs_path)
+        if local_sudo:
+            cmd = 'sudo /bin/sh -c {0:s}'.format(_quote(cmd))
+        if _output.running:
+            print('[localhost] pull: {0:s}'.format(cmd))
+        _local(cmd)
 
-    assert buildout_directory, u'No path found for the selected hostout'
+    if os.path.getsize(datafs_path) != remote_size:
+        return False
 
-    buildout_sub_directory = lambda x: os.path.join(buildout_directory, x)
-    var_directory = buildout_sub_directory('var')
+    _save_state('datafs', {
+        'size': remote_size,
+        'fingerprint': _datafs_fingerprint(datafs_path, remote_size)
+    })
+    return True
 
-    # Make sure that the buildout directory exists on the remote
-    if remote_sudo:
-        _sudo('mkdir -p {0:s}'.format(var_directory))
-        _sudo('chown {0:s} {1:s}'.format(effective_user, buildout_directory))
-        _sudo('chown {0:s} {1:s}'.format(effective_user, var_directory))
+
+def _pull_datafs_repozo(datafs_path, effective_user):
+    """Pull Data.fs as a consistent snapshot by creating an incremental
+    repozo backup on the remote site, pulling only the new backup files and
+    restoring Data.fs from them locally.
+
+    """
+    buildout_directory = _env.hostout.options.get('path')
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+    repozo = os.path.join(buildout_directory, 'bin', 'repozo')
+    backup_directory = _env.hostout.options.get('repozo-directory') or \
+        os.path.join(buildout_directory, 'var', 'backups', 'pushdeploy')
+
+    # Backup (incremental, unless the remote has been packed, when the
+    # older full backups and their increments are removed)
+    _remote_batch([
+        'mkdir -p {0:s}'.format(backup_directory),
+        '{0:s} -B -k -f {1:s} -r {2:s}'.format(repozo, datafs_path,
+                                                backup_directory)
+    ])
+
+    # Pull the new backup files
+    if not os.path.exists(backup_directory):
+        cmd = 'mkdir -p {0:s}'.format(backup_directory)
+        if local_sudo:
+            cmd = 'sudo {0:s}'.format(cmd)
+        if _output.running:
+            print('[localhost] pull: {0:s}'.format(cmd))
+        _local(cmd)
+    _rsync(backup_directory + '/', backup_directory, delete=True,
+           chown=effective_user)
+
+    # Restore
+    for cmd in ['{0:s} -R -r {1:s} -o {2:s}.tmp'.format(
+                    repozo, backup_directory, datafs_path),
+                'rm -f {0:s}.index'.format(datafs_path),
+                'mv {0:s}.tmp {0:s}'.format(datafs_path),
+                'chown {0:s} {1:s}'.format(effective_user, datafs_path)]:
+        if local_sudo:
+            cmd = 'sudo {0:s}'.format(cmd)
+        if _output.running:
+            print('[localhost] pull: {0:s}'.format(cmd))
+        _local(cmd)
+
+
+def _blob_shards(blobstorage_directory, count):
+    """Split the remote blobstorage into shards of OID directories. Returns
+    the shard depth and a list of (relative path, size in kB) -tuples sorted
+    by size starting from the largest one.
+
+    """
+    # Descend until there are enough shards (the bushy layout starts with
+    # the same few directories until the significant bytes of the OIDs)
+    depth = 0
+    for candidate in range(1, 9):
+        cmd = ("test -d {0:s} && cd {0:s} && "
+               "find . -mindepth {1:d} -maxdepth {1:d} -type d -name '0x*' "
+               "| wc -l || echo 0").format(blobstorage_directory, candidate)
+        with _hide('stdout'):
+            found = int(_remote(cmd).strip() or 0)
+        if not found:
+            break
+        depth = candidate
+        if found >= count * 4:
+            break
+
+    if not depth:
+        return depth, []
+
+    cmd = ("cd {0:s} && find . -mindepth {1:d} -maxdepth {1:d} -type d "
+           "-name '0x*' -exec du -sk {{}} +").format(
+        blobstorage_directory, depth)
+    with _hide('stdout'):
+        listing = _remote(cmd)
+
+    shards = []
+    for line in listing.splitlines():
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[1].startswith('./'):
+            shards.append((parts[1][2:], int(parts[0])))
+    shards.sort(key=lambda shard: shard[1], reverse=True)
+    return depth, shards
+
+
+def _pull_blobstorage_parallel(var_directory, workers, effective_user):
+    """Pull the blobstorage with parallel rsync workers, one shard of OID
+    directories at a time (largest first). Failed shards are retried
+    ``blob-pull-retries`` times (default: 2) before giving up.
+
+    """
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+    retries = int(_env.hostout.options.get('blob-pull-retries') or 2)
+    blobstorage_directory = os.path.join(var_directory, 'blobstorage')
+
+    depth, shards = _blob_shards(blobstorage_directory, workers)
+    if not shards:
+        _rsync(blobstorage_directory, var_directory, delete=True,
+               chown=effective_user, compress=False)
+        return
+
+    # Remove the local shards, which no longer exist on the remote
+    remote_shards = set([path for path, size in shards])
+    local_shards = ['']
+    for level in range(depth):
+        local_shards = [os.path.join(path, name) for path in local_shards
+                        if os.path.isdir(os.path.join(blobstorage_directory,
+                                                      path))
+                        for name in os.listdir(os.path.join(
+                            blobstorage_directory, path))
+                        if name.startswith('0x')]
+    stale = [os.path.join(blobstorage_directory, path)
+             for path in local_shards if path not in remote_shards]
+    if stale:
+        cmd = 'rm -rf {0:s}'.format(' '.join(stale))
+        if local_sudo:
+            cmd = 'sudo {0:s}'.format(cmd)
+        if _output.running:
+            print('[localhost] pull: {0:s}'.format(cmd))
+        _local(cmd)
+
+    # Pull everything above the shards (with deletions)
+    _rsync(blobstorage_directory, var_directory, delete=True,
+           exclude=('/blobstorage/' + '*/' * (depth - 1) + '0x*/',),
+           chown=effective_user, compress=False)
+
+    # Pull the shards (with deletions)
+    pending = _queue.Queue()
+    for path, size in shards:
+        pending.put((path, 0))
+    failed = []
+    output_lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                path, attempt = pending.get_nowait()
+            except _queue.Empty:
+                return
+            shard_directory = os.path.join(blobstorage_directory, path)
+            res = _rsync(shard_directory, os.path.dirname(shard_directory),
+                         delete=True, capture=True, chown=effective_user,
+                         compress=False)
+            if not res.failed:
+                continue
+            with output_lock:
+                print('[localhost] pull: shard {0:s} failed '
+                      '(attempt {1:d}/{2:d})'.format(path, attempt + 1,
+                                                     retries + 1))
+                if attempt < retries:
+                    pending.put((path, attempt + 1))
+                else:
+                    failed.append(path)
+
+    with _settings(warn_only=True):
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(workers, len(shards)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if failed:
+        _abort(u'Pulling blobstorage failed for shards: {0:s}'.format(
+            ' '.join(sorted(failed))))
+
+
+def _pull_blobs(blobstorage_directory, names, effective_user):
+    """Pull only the named files (relative to the blobstorage) from the
+    remote blobstorage.
+
+    """
+    if not os.path.isdir(blobstorage_directory):
+        os.makedirs(blobstorage_directory)
+    extra_opts = ''
+    if _rsync_version() >= (3, 1, 0):
+        extra_opts = '--ignore-missing-args'
+
+    fd, files_from = tempfile.mkstemp(prefix='pushdeploy-', suffix='.files')
+    try:
+        with os.fdopen(fd, 'w') as files_from_file:
+            files_from_file.write('\n'.join(names) + '\n')
+        _rsync(blobstorage_directory + '/', blobstorage_directory,
+               extra_opts='{0:s} --files-from={1:s}'.format(
+                   extra_opts, files_from).strip(),
+               chown=effective_user, compress=False)
+    finally:
+        os.unlink(files_from)
+
+
+def _write_fetch_script(buildout_directory, blobstorage_directory):
+    """Write a shell script into the state directory, which fetches the
+    given blobs (paths in the local blobstorage, absolute or relative to the
+    buildout) from the remote site, e.g. when a partially pulled staging
+    site misses them.
+
+    """
+    user, host, port = _remote_host()
+    rsync_path = ''
+    if _env.hostout.options.get('remote-sudo') == 'true':
+        rsync_path = ' --rsync-path="sudo rsync"'
+    script_path = _state_path('fetch-blobs')
+    with open(script_path, 'w') as script:
+        # The shared master connection ends with the task, so the script
+        # must open its own
+        script.write('\n'.join([
+            '#!/bin/sh',
+            '# Fetch the given blobs from {0:s}'.format(host),
+            'buildout={0:s}'.format(_quote(buildout_directory)),
+            'blobstorage={0:s}'.format(_quote(blobstorage_directory)),
+            'names=',
+            'for path in "$@"; do',
+            '    case "$path" in',
+            '        /*) ;;',
+            '        *) path="$buildout/${path#./}" ;;',
+            '    esac',
+            '    case "$path" in',
+            '        */../*|*/..) ;;',
+            '        "$blobstorage"/?*)',
+            '            names="$names${path#"$blobstorage"/}',
+            '"',
+            '            continue ;;',
+            '    esac',
+            '    echo "No blob $path found in the blobstorage" >&2',
+            '    exit 1',
+            'done',
+            'printf %s "$names" | rsync -pthl{0:s} --files-from=- '
+            '-e "{1:s}" {2:s}@{3:s}:"$blobstorage"/ "$blobstorage"/'.format(
+                rsync_path, _ssh_command(shared=False), user, host), '']))
+    os.chmod(script_path, 0o755)
+    return script_path
+
+
+def _pull_blobstorage_partial(var_directory, effective_user):
+    """Pull only the blobs below ``blob-pull-paths`` -hostout-option (paths
+    relative to the blobstorage), modified during the last
+    ``blob-pull-max-age`` -hostout-option days and (latest first) until
+    ``blob-pull-max-size`` -hostout-option megabytes.
+
+    """
+    blobstorage_directory = os.path.join(var_directory, 'blobstorage')
+    max_age = _env.hostout.options.get('blob-pull-max-age')
+    max_size = _env.hostout.options.get('blob-pull-max-size')
+    paths = (_env.hostout.options.get('blob-pull-paths') or '').split()
+
+    # List the matching remote blobs
+    cmd = ('cd {0:s} && find {1:s} -type f{2:s} -printf "%T@ %s %p\\n" '
+           '2>/dev/null || true').format(
+        blobstorage_directory,
+        ' '.join([_quote(os.path.join('.', path)) for path in paths]) or '.',
+        max_age and ' -mtime -{0:d}'.format(int(max_age)) or '')
+    with _hide('stdout'):
+        listing = _remote(cmd)
+    blobs = []
+    for line in listing.splitlines():
+        values = line.strip().split(' ', 2)
+        if len(values) == 3 and values[2].startswith('./'):
+            blobs.append((float(values[0]), int(values[1]), values[2][2:]))
+
+    # Select the latest blobs within the budget
+    blobs.sort(reverse=True)
+    budget = max_size and float(max_size) * 1024 * 1024 or None
+    names = []
+    total = 0
+    for mtime, size, name in blobs:
+        if budget is not None and total + size > budget:
+            break
+        total += size
+        names.append(name)
+    if _output.running:
+        print('[localhost] pull: {0:d} of {1:d} blobs ({2:s})'.format(
+            len(names), len(blobs), _format_size(total)))
+
+    # Pull (with the layout marker, when rsync can ignore it missing)
+    if _rsync_version() >= (3, 1, 0):
+        names.append('.layout')
+    _pull_blobs(blobstorage_directory, sorted(names), effective_user)
+
+    script_path = _write_fetch_script(os.path.dirname(var_directory),
+                                      blobstorage_directory)
+    if _output.running:
+        print('[localhost] pull: missing blobs could be fetched with '
+              '{0:s} or fetch_blobs'.format(script_path))
+
+
+@_task
+def pull():
+    """Pull the data from the remote site into the local buildout.
+    """
+    # Serialize with the other pulls (e.g. a running mirror)
+    with _resource_lock('data'):
+        _pull_data()
+
+
+def _pull_data():
+    """Pull Data.fs and blobstorage from the remote site.
+    """
+
+    buildout_directory = _env.hostout.options.get('path')
+    fallback_user = _env.user or 'root'
+    effective_user = _env.hostout.options.get('effective-user', fallback_user)
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    var_directory = os.path.join(buildout_directory, 'var')
+    filestorage_directory = os.path.join(var_directory, 'filestorage')
+
+    # Ensure filestorage
+    with _resource_lock('var'):
+        if not os.path.exists(var_directory):
+            cmd = 'mkdir -p {0:s}'.format(filestorage_directory)
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] pull: {0:s}'.format(cmd))
+            _local(cmd)
+
+            # Chown
+            cmd = 'chown {0:s} {1:s} {2:s}'.format(
+                effective_user, var_directory, filestorage_directory)
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] pull: {0:s}'.format(cmd))
+            _local(cmd)
+
+    # Pull filestorage
+    datafs_path = os.path.join(filestorage_directory, 'Data.fs')
+    mode = _env.hostout.options.get('datafs-pull')
+    incremental = mode == 'incremental'
+    if mode == 'repozo':
+        _pull_datafs_repozo(datafs_path, effective_user)
+    elif not incremental or not _pull_datafs_incremental(datafs_path):
+        _rsync(datafs_path, datafs_path, delete=True,
+               chown=effective_user, chown_directory=filestorage_directory)
+        if incremental:
+            size = os.path.getsize(datafs_path)
+            _save_state('datafs', {
+                'size': size,
+                'fingerprint': _datafs_fingerprint(datafs_path, size)
+            })
+
+    # Pull blobstorage
+    workers = int(_env.hostout.options.get('blob-pull-workers') or 1)
+    partial = any([_env.hostout.options.get(option) for option in (
+        'blob-pull-max-age', 'blob-pull-max-size', 'blob-pull-paths')])
+    if partial:
+        _pull_blobstorage_partial(var_directory, effective_user)
+    elif workers > 1:
+        _pull_blobstorage_parallel(var_directory, workers, effective_user)
     else:
-        _run('mkdir -p {0:s}'.format(var_directory))
-        _run('chown {0:s} {1:s}'.format(effective_user, buildout_directory))
-        _run('chown {0:s} {1:s}'.format(effective_user, var_directory))
+        _rsync(os.path.join(var_directory, 'blobstorage'), var_directory,
+               delete=True, chown=effective_user, compress=False)
+
+
+@_task
+def fetch_blobs(*paths):
+    """Fetch the given blobs (paths in the local blobstorage, absolute or
+    relative to the buildout) from the remote site into the partially pulled
+    local blobstorage.
+    """
+    buildout_directory = _env.hostout.options.get('path')
+    fallback_user = _env.user or 'root'
+    effective_user = _env.hostout.options.get('effective-user', fallback_user)
+
+    assert buildout_directory, u'No path found for the selected hostout'
+    assert paths, u'No blobs given'
+
+    blobstorage_directory = os.path.join(buildout_directory, 'var',
+                                         'blobstorage')
+    names = []
+    for path in paths:
+        name = os.path.relpath(os.path.join(buildout_directory, path),
+                               blobstorage_directory)
+        assert name != os.curdir and not name.startswith(os.pardir), \
+            u'No blob {0:s} found in the blobstorage'.format(path)
+        names.append(name)
+    _pull_blobs(blobstorage_directory, names, effective_user)
+
+
+def mirror(*args):
+    """Keep pulling the data from the remote site into the local buildout
+    every ``mirror-interval`` -hostout-option seconds (default: 300) or only
+    once with ``--once``.
+    """
+    once = '--once' in args
+    interval = int(_env.hostout.options.get('mirror-interval') or 300)
+
+    while True:
+        started = time.time()
+        try:
+            pull()
+        except (Exception, SystemExit) as e:
+            if once:
+                raise
+            print('[localhost] mirror: pull failed: {0:s}'.format(str(e)))
+        else:
+            if _output.running and not once:
+                print('[localhost] mirror: pulled in {0:.1f}s'.format(
+                    time.time() - started))
+        if once:
+            break
+        time.sleep(max(0, interval - (time.time() - started)))
+
+
+def _stage_fingerprint():
+    """Return fingerprint of the inputs of the local buildout: repository
+    revision, the read buildout configuration files, bootstrap python and
+    the version pins.
+
+    """
+    buildout_directory = _env.hostout.options.get('path')
+    fallback_user = _env.user or 'root'
+    buildout_user = _env.hostout.options.get('buildout-user', fallback_user)
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+
+    # Revision
+    with _lcd(buildout_directory):
+        cmd = 'su {0:s} -c "hg id -i"'.format(buildout_user)
+        if local_sudo:
+            cmd = 'sudo {0:s}'.format(cmd)
+        revision = _local(cmd, capture=True).strip()
+
+    sections = _annotate_sections(buildout_directory, buildout_user)
+    bootstrap_python = (
+        _env.hostout.options.get('bootstrap-python') or
+        _env.hostout.options.get('executable')
+    )
+
+    checksum = hashlib.sha1()
+    checksum.update(json.dumps([
+        revision, sections['key'], bootstrap_python,
+        sorted(sections['versions'].items())
+    ]).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+# Compiles the stale Python sources below the given directories in parallel
+# (with the buildout python) and prints the paths of the compiled sources
+_PRECOMPILE_SCRIPT = '''\
+import multiprocessing
+import os
+import py_compile
+import sys
+
+try:
+    from importlib.util import cache_from_source
+except ImportError:
+    def cache_from_source(path):
+        return path + 'c'
+
+
+def stale(path):
+    compiled = cache_from_source(path)
+    return (not os.path.exists(compiled) or
+            os.path.getmtime(compiled) < os.path.getmtime(path))
+
+
+def compile_source(path):
+    try:
+        py_compile.compile(path, doraise=True)
+        return path
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    sources = []
+    for directory in sys.argv[1:]:
+        for root, directories, files in os.walk(directory):
+            sources.extend([os.path.join(root, name) for name in files
+                            if name.endswith('.py')
+                            and stale(os.path.join(root, name))])
+    pool = multiprocessing.Pool()
+    for path in pool.imap_unordered(compile_source, sources, 64):
+        if path:
+            print(path)
+    pool.close()
+    pool.join()
+'''
+
+
+def precompile():
+    """Compile the changed Python sources of the local buildout into bytecode
+    (to be pushed with the buildout).
+    """
+    buildout_directory = _env.hostout.options.get('path')
+    fallback_user = _env.user or 'root'
+    buildout_user = _env.hostout.options.get('buildout-user', fallback_user)
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    buildout_python = _env.hostout.options.get('bootstrap-python') or \
+        _env.hostout.options.get('executable') or 'python'
 
-    # Push
     annotations = annotate()
+    buildout_sub_directory = lambda x: os.path.join(buildout_directory, x)
+    eggs_directory = buildout_sub_directory(annotations['eggs-directory'])
+    parts_directory = buildout_sub_directory(annotations['parts-directory'])
+    directories = [path for path in (eggs_directory, parts_directory,
+                                     buildout_sub_directory('products'))
+                   if os.path.isdir(path)]
+
+    fd, script_path = tempfile.mkstemp(prefix='pushdeploy-', suffix='.py')
+    try:
+        with os.fdopen(fd, 'w') as script:
+            script.write(_PRECOMPILE_SCRIPT)
+        os.chmod(script_path, 0o644)
+
+        cmd = '{0:s} {1:s} {2:s}'.format(buildout_python, script_path,
+                                         ' '.join(directories))
+        cmd = 'su {0:s} -c "{1:s}"'.format(buildout_user, cmd)
+        if local_sudo:
+            cmd = 'sudo {0:s}'.format(cmd)
+        if _output.running:
+            print('[localhost] precompile: {0:s}'.format(cmd))
+        with _hide('stdout'):
+            compiled = _local(cmd, capture=True).splitlines()
+    finally:
+        os.unlink(script_path)
+
+    if _output.running:
+        print('[localhost] precompile: {0:d} sources compiled'.format(
+            len(compiled)))
+
+    # Invalidate the cached hashes of the eggs with new bytecode
+    top_level = lambda directory: set([
+        os.path.relpath(path, directory).split(os.sep)[0]
+        for path in compiled if path.startswith(directory + os.sep)])
+    eggs = top_level(eggs_directory)
+    if eggs:
+        cache = _load_state('eggs', {})
+        for name in eggs:
+            cache.pop(name, None)
+        _save_state('eggs', cache)
+
+    # Remember the parts with new bytecode (for pushing only the changed
+    # parts)
+    parts = top_level(parts_directory)
+    if parts:
+        state = _load_state('precompiled', {})
+        state['parts'] = sorted(set(state.get('parts', [])) | parts)
+        _save_state('precompiled', state)
+
+
+def _stage_build(force=False):
+    """Bootstrap and run the local buildout unless their inputs are unchanged
+    since the last successful stage.
+
+    """
+    buildout_directory = _env.hostout.options.get('path')
+
+    fingerprint = _stage_fingerprint()
+    state = _load_state('stage', {})
+    unchanged = not force \
+        and state.get('fingerprint') == fingerprint \
+        and os.path.exists(os.path.join(buildout_directory, 'bin', 'buildout'))
+
+    if unchanged:
+        print('[localhost] stage: buildout inputs unchanged since the last '
+              'successful stage; skipping bootstrap and buildout')
+    else:
+        # Forget the last successful stage until this one succeeds
+        state.pop('fingerprint', None)
+        _save_state('stage', state)
+
+        # Bootstrap
+        with _phase('bootstrap'):
+            bootstrap()
+
+        # Buildout
+        with _phase('buildout'):
+            buildout()
+
+        state = _load_state('stage', {})
+        state['fingerprint'] = fingerprint
+        _save_state('stage', state)
+
+    # Precompile
+    if _env.hostout.options.get('precompile') == 'true':
+        with _phase('precompile'):
+            precompile()
+
+
+def _pull_process():
+    """Pull the data in a separate hostout process.
+    """
+    if _run_hostout(_env.hostout.name, 'pull') != 0:
+        _abort(u'Pull failed for the selected hostout')
+
+
+@_task
+def stage(*args):
+    """Update the local staged buildout (bootstrap and buildout are skipped
+    when their inputs are unchanged since the last successful stage, unless
+    ``--force`` is given)
+    """
+    buildout_directory = _env.hostout.options.get('path')
+    force = '--force' in args
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    # Pull the data alongside updating and building the code
+    if _env.hostout.options.get('parallel-stage') == 'true':
+        _schedule([
+            {'name': 'pull', 'func': _pull_process, 'requires': []},
+            {'name': 'update', 'func': update, 'requires': []},
+            {'name': 'build', 'func': lambda: _stage_build(force),
+             'requires': ['update']},
+            {'name': 'restart', 'func': _restart_local,
+             'requires': ['pull', 'build']}
+        ])
+        return
+
+    # Pull
+    pull()
+
+    # Update
+    with _phase('update'):
+        update()
+
+    # Bootstrap and buildout
+    _stage_build(force)
+
+    # Restart
+    with _phase('restart'):
+        _restart_local()
+
+
+def _restart_local():
+    """Run the configured restart commands on the local site, when
+    ``local-restart`` -hostout-option is set.
+    """
+    if _env.hostout.options.get('local-restart') == "true":
+        local_sudo = _env.hostout.options.get('local-sudo') == "true"
+        cmds = filter(bool, _env.hostout.options.get('restart').split('\n'))
+
+        assert cmds, u'No restart commands found for the selected hostout'
+
+        for cmd in cmds:
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] restart: {0:s}'.format(cmd))
+            _local(cmd)
+
+
+def _push_plan(buildout_directory, annotations):
+    """Return the list of directories to be pushed to the remote site.
+
+    Every item is a dict with a ``name``, the local ``directory``, the
+    remote ``root`` directory for its path relative to the buildout
+    directory (directories outside the buildout directory are always pushed
+    into the same path), an optional ``link_dest`` root for rsync's
+    --link-dest, rsync ``exclude`` patterns, rsync ``extra_opts``, a flag
+    whether the pushed files should be chown for effective-user and an
+    optional list of the ``only`` top-level names to be pushed.
+
+    """
+    buildout_sub_directory = lambda x: os.path.join(buildout_directory, x)
 
     bin_directory = buildout_sub_directory(annotations['bin-directory'])
     eggs_directory = buildout_sub_directory(annotations['eggs-directory'])
     parts_directory = buildout_sub_directory(annotations['parts-directory'])
     products_directory = buildout_sub_directory('products')
+    var_directory = buildout_sub_directory('var')
+    etc_directory = buildout_sub_directory('etc')
 
-    for directory in [bin_directory, eggs_directory, parts_directory]:
-        _rsync(directory, os.path.join(directory, '*'),
-               reverse=True, delete=False)
-        # Chown
-        cmd = 'chown -R {0:s} {1:s}'.format(effective_user, directory)
-        if remote_sudo:
-            _sudo(cmd)
-        else:
-            _run(cmd)
+    plan = []
+    for name, directory in [('bin', bin_directory), ('eggs', eggs_directory),
+                            ('parts', parts_directory)]:
+        plan.append({'name': name, 'directory': directory,
+                     'root': buildout_directory, 'link_dest': None,
+                     'exclude': (), 'extra_opts': '', 'chown': True,
+                     'only': None})
 
     if os.path.isdir(products_directory):
-        _rsync(products_directory, os.path.join(products_directory, '*'),
-               reverse=True, delete=False)
-        # Chown
-        cmd = 'chown -R {0:s} {1:s}'.format(effective_user, products_directory)
-        if remote_sudo:
-            _sudo(cmd)
-        else:
-            _run(cmd)
-
-    _rsync(var_directory, os.path.join(var_directory, '*'),
-           reverse=True, delete=False,
-           exclude=('blobstorage*', '*.fs', '*.old', '*.zip', '*.log',
-                    '*.backup'),
-           extra_opts='--ignore-existing')
+        plan.append({'name': 'products', 'directory': products_directory,
+                     'root': buildout_directory, 'link_dest': None,
+                     'exclude': (), 'extra_opts': '', 'chown': True,
+                     'only': None})
+
+    plan.append({'name': 'var', 'directory': var_directory,
+                 'root': buildout_directory, 'link_dest': None,
+                 'exclude': ('blobstorage*', '*.fs', '*.old', '*.zip',
+                             '*.log', '*.backup'),
+                 'extra_opts': '--ignore-existing', 'chown': True,
+                 'only': None})
 
     # Push 'etc' (created by some buildout scripts)
-    etc_directory = os.path.join(buildout_directory, 'etc')
     if os.path.exists(etc_directory):
-        _rsync(etc_directory, os.path.join(etc_directory, '*'),
-               reverse=True, delete=False)
-    # Chown
-    if os.path.exists(etc_directory):
-        cmd = 'chown -R {0:s} {1:s}'.format(effective_user, etc_directory)
-        if remote_sudo:
-            _sudo(cmd)
+        plan.append({'name': 'etc', 'directory': etc_directory,
+                     'root': buildout_directory, 'link_dest': None,
+                     'exclude': (), 'extra_opts': '', 'chown': True,
+                     'only': None})
+
+    return plan
+
+
+def _push_remote_directory(buildout_directory, item):
+    """Return the remote directory for the given push plan item.
+    """
+    relative = os.path.relpath(item['directory'], buildout_directory)
+    if relative.startswith(os.pardir):
+        return item['directory']
+    return os.path.join(item['root'], relative)
+
+
+def _push_single_pass(buildout_directory, plan, effective_user):
+    """Push all planned directories below the buildout directory with a
+    single rsync session per remote root. Returns the items, which could not
+    be merged (because they are located outside the buildout directory).
+
+    """
+    merged = {}
+    separate = []
+    for item in plan:
+        relative = os.path.relpath(item['directory'], buildout_directory)
+        if relative.startswith(os.pardir):
+            separate.append(item)
         else:
-            _run(cmd)
+            merged.setdefault((item['root'], item['link_dest']), []).append(
+                (relative, item))
+
+    for (root, link_dest), items in sorted(merged.items()):
+        # Rsync's --ignore-existing is global, so we emulate it for the
+        # items requiring it by excluding the files already existing on the
+        # remote
+        rules = []
+        for relative, item in items:
+            anchor = '/{0:s}/'.format(relative)
+            for pattern in item['exclude']:
+                rules.append('- {0:s}{1:s}'.format(anchor, pattern))
+                rules.append('- {0:s}**/{1:s}'.format(anchor, pattern))
+            if item['only'] is not None:
+                for name in item['only']:
+                    rules.append('+ {0:s}{1:s}'.format(anchor, name))
+                rules.append('- {0:s}*'.format(anchor))
+            if '--ignore-existing' in item['extra_opts'].split():
+                prune = ' -o '.join(["-name '{0:s}'".format(pattern)
+                                     for pattern in item['exclude']])
+                prune = prune and '\\( {0:s} \\) -prune -o '.format(prune)
+                cmd = ('test -d {0:s} && cd {0:s} && '
+                       'find . {1:s}! -type d -print || true').format(
+                    os.path.join(root, relative), prune)
+                with _hide('stdout'):
+                    existing = _remote(cmd)
+                for path in existing.splitlines():
+                    path = path.strip()
+                    if path.startswith('./'):
+                        rules.append('- {0:s}{1:s}'.format(anchor, path[2:]))
+
+        extra_opts = '--relative'
+        if link_dest:
+            extra_opts += ' --link-dest={0:s}'.format(link_dest)
+
+        fd, filter_path = tempfile.mkstemp(prefix='pushdeploy-',
+                                           suffix='.rules')
+        try:
+            with os.fdopen(fd, 'w') as filter_file:
+                filter_file.write('\n'.join(rules) + '\n')
+            sources = ' '.join([os.path.join(buildout_directory, '.',
+                                             relative)
+                                for relative, item in items])
+            _rsync(root + '/', sources, reverse=True, delete=False,
+                   extra_opts='{0:s} --exclude-from={1:s}'.format(
+                       extra_opts, filter_path),
+                   chown=effective_user)
+        finally:
+            os.unlink(filter_path)
+
+    return separate
+
+
+# Name of the egg manifest file cached in the remote eggs-directory
+_EGG_MANIFEST = '.pushdeploy-manifest.json'
+
+
+def _egg_hash(path):
+    """Return content hash for the egg (directory or file) at path.
+    """
+    checksum = hashlib.sha1()
+    if not os.path.isdir(path):
+        with open(path, 'rb') as egg:
+            checksum.update(egg.read())
+        return checksum.hexdigest()
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            checksum.update(os.path.relpath(file_path, path).encode('utf-8'))
+            if os.path.islink(file_path):
+                checksum.update(os.readlink(file_path).encode('utf-8'))
+            else:
+                with open(file_path, 'rb') as egg_file:
+                    checksum.update(hashlib.sha1(egg_file.read()).digest())
+    return checksum.hexdigest()
+
+
+def _egg_manifest(eggs_directory):
+    """Return the manifest of the local eggs-directory as a dict of egg names
+    and content hashes. Eggs are immutable, so only the eggs, which are new
+    or have a new mtime since the last call, are hashed.
+
+    """
+    cache = _load_state('eggs', {})
+    state = {}
+    manifest = {}
+    for name in sorted(os.listdir(eggs_directory)):
+        if name.startswith('.'):
+            continue
+        path = os.path.join(eggs_directory, name)
+        mtime = os.path.getmtime(path)
+        cached = cache.get(name)
+        if cached and cached['mtime'] == mtime:
+            manifest[name] = cached['hash']
+        else:
+            manifest[name] = _egg_hash(path)
+        state[name] = {'mtime': mtime, 'hash': manifest[name]}
+    _save_state('eggs', state)
+    return manifest
+
+
+def _remote_egg_manifest(eggs_directory):
+    """Return the manifest cached in the remote eggs-directory.
+    """
+    cmd = 'cat {0:s} 2>/dev/null || true'.format(
+        os.path.join(eggs_directory, _EGG_MANIFEST))
+    with _hide('stdout'):
+        res = _remote(cmd)
+    try:
+        return json.loads(res or '{}')
+    except ValueError:
+        return {}
+
+
+def _upload_egg_manifest(eggs_directory, manifest, effective_user):
+    """Cache the given manifest in the remote eggs-directory.
+    """
+    manifest_directory = tempfile.mkdtemp(prefix='pushdeploy-')
+    try:
+        path = os.path.join(manifest_directory, _EGG_MANIFEST)
+        with open(path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=0, sort_keys=True)
+        _rsync(eggs_directory + '/', path, reverse=True, delete=False,
+               chown=effective_user)
+    finally:
+        shutil.rmtree(manifest_directory, ignore_errors=True)
+
+
+def _link_from_egg_store(egg_store, eggs_directory, manifest, names):
+    """Hard link the given eggs from the remote shared egg store into the
+    remote eggs-directory. Returns the names of the eggs, which were found
+    (and linked) from the store.
+
+    """
+    if not names:
+        return []
+    script = ['mkdir -p {0:s}'.format(_quote(eggs_directory)),
+              'cd {0:s} 2>/dev/null || exit 0'.format(_quote(egg_store))]
+    for name in names:
+        source = os.path.join(egg_store, manifest[name], name)
+        target = os.path.join(eggs_directory, name)
+        script.append(
+            'if [ -e {0:s} ]; then rm -rf {1:s}; '
+            'if cp -al {0:s} {1:s}; then echo {2:s}; '
+            'else rm -rf {1:s}; echo {3:s}; fi; '
+            'fi'.format(_quote(source), _quote(target),
+                        _quote('linked:' + name), _quote('missed:' + name)))
+    with _hide('stdout'):
+        res = _remote('\n'.join(script))
+    lines = res.replace('\r\n', '\n').splitlines()
+    linked = set([line[len('linked:'):] for line in lines
+                  if line.startswith('linked:')])
+    missed = [line for line in lines if line.startswith('missed:')]
+    if missed:
+        print('[{0:s}] egg store: {1:d} eggs could not be linked:\n'
+              '{2:s}'.format(_env.host_string, len(missed), '\n'.join(
+                  [line for line in lines
+                   if not line.startswith('linked:')])))
+    return [name for name in names if name in linked]
+
+
+def _add_to_egg_store(egg_store, eggs_directory, manifest, names):
+    """Hard link the given (just pushed) eggs from the remote
+    eggs-directory into the remote shared egg store.
+
+    """
+    if not names:
+        return
+    script = ['mkdir -p {0:s}'.format(_quote(egg_store))]
+    for name in names:
+        directory = os.path.join(egg_store, manifest[name])
+        script.append(
+            '[ -e {0:s} ] || {{ mkdir -p {1:s} && '
+            'cp -al {2:s} {0:s} 2>/dev/null || rm -rf {0:s}; }}'.format(
+                _quote(os.path.join(directory, name)), _quote(directory),
+                _quote(os.path.join(eggs_directory, name))))
+    with _settings(warn_only=True):
+        _remote('\n'.join(script))
+
+
+def _installed_parts(text):
+    """Parse the given contents of .installed.cfg into a dict of the
+    installed parts and their options.
+
+    """
+    parser = _RawConfigParser()
+    parser.optionxform = str
+    if hasattr(parser, 'read_string'):
+        parser.read_string(text)
+    else:
+        parser.readfp(io.BytesIO(text))
+    return dict([(part, dict(parser.items(part)))
+                 for part in parser.sections() if part != 'buildout'])
+
+
+def _remote_installed_parts(root):
+    """Return the installed parts of the .installed.cfg last pushed into the
+    given remote root (or None when there is no such file).
+
+    """
+    cmd = 'cat {0:s} 2>/dev/null || true'.format(
+        os.path.join(root, '.installed.cfg'))
+    with _hide('stdout'):
+        res = _remote(cmd)
+    if not res.strip():
+        return None
+    return _installed_parts(res.replace('\r\n', '\n'))
+
+
+def _installed_names(directory, installed, parts):
+    """Return the top-level names below the given directory installed by the
+    given parts.
+
+    """
+    names = set()
+    for part in parts:
+        paths = installed[part].get('__buildout_installed__', '').split()
+        for path in paths:
+            relative = os.path.relpath(path, directory)
+            if relative != os.curdir and not relative.startswith(os.pardir):
+                names.add(relative.split(os.sep)[0])
+    return sorted(names)
+
+
+def _part_fingerprints(installed):
+    """Return a dict of the given installed parts and the checksums of their
+    options and the names, sizes and modification times of the files they
+    have installed.
+
+    """
+    fingerprints = {}
+    for part, options in installed.items():
+        checksum = hashlib.sha1(json.dumps(
+            options, sort_keys=True).encode('utf-8'))
+        for path in options.get('__buildout_installed__', '').split():
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    checksum.update(_file_signature(
+                        os.path.join(dirpath, name)))
+            if os.path.isfile(path):
+                checksum.update(_file_signature(path))
+        fingerprints[part] = checksum.hexdigest()
+    return fingerprints
+
+
+def _file_signature(path):
+    """Return the path, size and modification time of the given file.
+    """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return path.encode('utf-8')
+    return '{0:s}\0{1:d}\0{2:d}\n'.format(
+        path, info.st_size, int(info.st_mtime)).encode('utf-8')
+
+
+_ARTIFACTS = '.pushdeploy-artifacts'
+
+
+def _top_level_item(buildout_directory, item):
+    """Return True for the push plan items, which are top-level directories
+    of the buildout (except var).
+
+    """
+    relative = os.path.relpath(item['directory'], buildout_directory)
+    return relative != 'var' and os.sep not in relative \
+        and not relative.startswith(os.pardir)
 
 
+def _build_artifact(buildout_directory, names):
+    """Return the local artifact (a gzipped tarball) of the named top-level
+    directories of the buildout as an open file, which holds a shared lock
+    on the artifact (to protect it from pruning) until closed. The artifact
+    is versioned by the listing of the files and built only once for every
+    hostout pushing the same buildout (into ``artifact-directory``, which
+    defaults to ``~/.pushdeploy/artifacts``).
+
+    """
+    local_sudo = _env.hostout.options.get('local-sudo') == "true"
+    artifact_directory = _env.hostout.options.get('artifact-directory') or \
+        os.path.join(os.path.expanduser('~'), '.pushdeploy', 'artifacts')
+    if not os.path.isdir(artifact_directory):
+        os.makedirs(artifact_directory)
+
+    # Version (prefixed with the buildout, which the artifact belongs to)
+    prefix = hashlib.sha1(buildout_directory.encode('utf-8')).hexdigest()[:12]
+    checksum = hashlib.sha1()
+    for name in names:
+        for root, directories, files in os.walk(
+                os.path.join(buildout_directory, name)):
+            directories.sort()
+            for file_name in sorted(files):
+                path = os.path.join(root, file_name)
+                stat = os.lstat(path)
+                checksum.update('{0:s} {1:d} {2:d}\n'.format(
+                    os.path.relpath(path, buildout_directory), stat.st_size,
+                    int(stat.st_mtime)).encode('utf-8'))
+    artifact_path = os.path.join(artifact_directory, '{0:s}-{1:s}.tar.gz'
+                                 .format(prefix, checksum.hexdigest()))
+
+    lock_path = os.path.join(artifact_directory, '.lock')
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(artifact_path):
+                artifact = open(artifact_path, 'rb')
+                fcntl.flock(artifact, fcntl.LOCK_SH)
+                return artifact
+
+            # Compress so that rsync can transfer it as a delta
+            with open(os.devnull, 'w') as devnull:
+                rsyncable = subprocess.call(
+                    ['gzip', '--rsyncable', '-c', os.devnull],
+                    stdout=devnull, stderr=devnull) == 0
+            cmd = 'tar -C {0:s} -cf - {1:s} | gzip{2:s} > {3:s}.tmp'.format(
+                buildout_directory, ' '.join(names),
+                rsyncable and ' --rsyncable' or '', artifact_path)
+            if local_sudo:
+                cmd = 'sudo {0:s}'.format(cmd)
+            if _output.running:
+                print('[localhost] artifact: {0:s}'.format(cmd))
+            _local(cmd)
+            os.rename(artifact_path + '.tmp', artifact_path)
+            artifact = open(artifact_path, 'rb')
+            fcntl.flock(artifact, fcntl.LOCK_SH)
+
+            # Keep only the two latest artifacts of the buildout (and the
+            # ones still being pushed)
+            artifacts = sorted([
+                os.path.join(artifact_directory, name)
+                for name in os.listdir(artifact_directory)
+                if name.startswith(prefix + '-')
+                and name.endswith('.tar.gz')], key=os.path.getmtime)
+            for path in artifacts[:-2]:
+                with open(path, 'rb') as old_artifact:
+                    try:
+                        fcntl.flock(old_artifact,
+                                    fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except (IOError, OSError):
+                        continue
+                    os.unlink(path)
+            return artifact
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _push_artifact(buildout_directory, items, effective_user):
+    """Push the given top-level push plan items as a single artifact, which
+    is either relayed from the host of ``artifact-relay`` -hostout-section or
+    uploaded from the local site, and unpacked on the remote site.
+
+    """
+    names = sorted([os.path.relpath(item['directory'], buildout_directory)
+                    for item in items])
+    root = items[0]['root']
+    with _build_artifact(buildout_directory, names) as artifact:
+        _upload_artifact(buildout_directory, artifact.name)
+    artifact_name = os.path.basename(artifact.name)
+    remote_path = os.path.join(buildout_directory, _ARTIFACTS, artifact_name)
+
+    # Unpack as the effective user (and keep only the current artifact as
+    # the base for the next)
+    unpack = 'tar --no-same-owner -xzf {0:s} -C {1:s} {2:s}'.format(
+        remote_path, root, ' '.join(names))
+    _remote_batch([
+        'mkdir -p {0:s} && chown {1:s} {0:s}'.format(root, effective_user),
+        'if [ "$(id -un)" = {0:s} ]; then {1:s}; '
+        'else su {0:s} -s /bin/sh -c {2:s}; fi'.format(
+            effective_user, unpack, _quote(unpack)),
+        'find {0:s} -type f ! -name {1:s} -delete'.format(
+            os.path.dirname(remote_path), artifact_name)
+    ])
+
+
+def _upload_artifact(buildout_directory, artifact_path):
+    """Relay the given artifact from the host of ``artifact-relay``
+    -hostout-section or upload it from the local site.
+
+    """
+    artifact_name = os.path.basename(artifact_path)
+    remote_directory = os.path.join(buildout_directory, _ARTIFACTS)
+
+    _remote_batch(['mkdir -p {0:s}'.format(remote_directory)])
+
+    # Relay the artifact from another host (which already has it)
+    relayed = False
+    relay = _env.hostout.options.get('artifact-relay')
+    if relay and relay != _env.hostout.name:
+        assert relay in _env.hostout.hostouts, \
+            u'No hostout section found for {0:s}'.format(relay)
+        relay_options = _env.hostout.hostouts[relay].options
+        relay_path = os.path.join(relay_options.get('path'), _ARTIFACTS,
+                                  artifact_name)
+        cmd = 'rsync -pt --fuzzy -e "ssh -o BatchMode=yes" ' \
+              '{0:s}@{1:s}:{2:s} {3:s}/'.format(
+                  relay_options.get('user') or 'root',
+                  relay_options.get('host'), relay_path, remote_directory)
+        with _settings(warn_only=True):
+            relayed = not _remote(cmd).failed
+        if not relayed:
+            print('Warning: relay from {0:s} failed, uploading'.format(relay))
+
+    # Upload the artifact (as a delta against the previous one)
+    if not relayed:
+        _rsync(remote_directory + '/', artifact_path, reverse=True,
+               delete=False, extra_opts='--fuzzy', compress=False)
+
+
+def _new_release(buildout_directory):
+    """Return a new (sortable) remote release id based on the current time
+    and suffixed when a release with the same id already exists.
+
+    """
+    release = time.strftime('%Y%m%d%H%M%S')
+    with _hide('stdout'):
+        existing = _remote('ls -1 {0:s} 2>/dev/null || true'.format(
+            os.path.join(buildout_directory, 'releases'))).split()
+    candidate, suffix = release, 0
+    while candidate in existing:
+        suffix += 1
+        candidate = '{0:s}-{1:02d}'.format(release, suffix)
+    return candidate
+
+
+def _current_release(buildout_directory):
+    """Return the id of the currently active remote release (or None, also
+    when the ``current`` symlink is broken).
+
+    """
+    cmd = '! test -d {0:s} || readlink {0:s} || true'.format(
+        os.path.join(buildout_directory, 'current'))
+    with _hide('stdout'):
+        target = _remote(cmd).strip()
+    return target and os.path.basename(target.rstrip('/')) or None
+
+
+def _activate_release_cmd(buildout_directory, release):
+    """Return the remote command for atomically re-pointing the ``current``
+    symlink to the given release. Real directories, which the release
+    replaces, are moved aside and replaced with symlinks into ``current`` on
+    the first activation.
+
+    """
+    return ('cd {0:s} && ln -sfn releases/{1:s} current.tmp && '
+           'mv -Tf current.tmp current && '
+           'for name in $(ls releases/{1:s}); do '
+           'if [ ! -L $name ]; then '
+           'if [ -e $name ]; then mv $name $name.pre-releases; fi; '
+           'ln -s current/$name $name; '
+           'fi; done').format(buildout_directory, release)
+
+
+def _prune_releases_cmd(buildout_directory, keep, current):
+    """Return the remote command for removing the oldest releases, but
+    keeping the given number of the latest ones and the current one.
+
+    """
+    return ('cd {0:s}/releases && ls -1 | sort | head -n -{1:d} | '
+            '{{ grep -v -x {2:s} || true; }} | xargs -r rm -rf').format(
+        buildout_directory, max(keep, 1), _quote(current))
+
+
+def _push_only(buildout_directory, item, extra_opts, effective_user):
+    """Push only the listed top-level names of the given push plan item.
+    """
+    fd, files_from = tempfile.mkstemp(prefix='pushdeploy-', suffix='.files')
+    try:
+        with os.fdopen(fd, 'w') as files_from_file:
+            files_from_file.write('\n'.join(item['only']) + '\n')
+        _rsync(_push_remote_directory(buildout_directory, item) + '/',
+               item['directory'] + '/',
+               reverse=True, delete=False, exclude=item['exclude'],
+               extra_opts='{0:s} --files-from={1:s}'.format(
+                   extra_opts, files_from).strip(),
+               chown=item['chown'] and effective_user or None)
+    finally:
+        os.unlink(files_from)
+
+
+@_task
+def push():
+    """Push the local buildout results (without data) to the remote site.
+    """
+
+    # TODO: Currently all remote directories are chown for effective-user.
+    # We should remote this for everything else except var-directory
+
+    buildout_directory = _env.hostout.options.get('path')
+
+    fallback_user = _env.user or 'root'
+    effective_user = _env.hostout.options.get('effective-user', fallback_user)
+    single_pass = _env.hostout.options.get('single-pass-push') == 'true'
+    releases = _env.hostout.options.get('releases') == 'true'
+    artifact_push = _env.hostout.options.get('artifact-push') == 'true'
+    changed_parts = _env.hostout.options.get('changed-parts') == 'true' \
+        and not artifact_push
+    egg_store = not artifact_push and _env.hostout.options.get('egg-store')
+    egg_manifest = _env.hostout.options.get('egg-manifest') == 'true' \
+        and not artifact_push or bool(egg_store)
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    buildout_sub_directory = lambda x: os.path.join(buildout_directory, x)
+    var_directory = buildout_sub_directory('var')
+
+    release = releases and _checkpoint_value(
+        'release', _new_release(buildout_directory)) or None
+    releases_directory = buildout_sub_directory('releases')
+    release_directory = os.path.join(releases_directory, release or '')
+
+    # Make sure that the buildout directory exists on the remote
+    if _step_pending('push:prepare'):
+        _remote_batch([
+            'mkdir -p {0:s}'.format(var_directory),
+            'chown {0:s} {1:s}'.format(effective_user, buildout_directory),
+            'chown {0:s} {1:s}'.format(effective_user, var_directory),
+            release and 'mkdir -p {0:s}'.format(release_directory),
+            release and 'chown {0:s} {1:s} {2:s}'.format(
+                effective_user, releases_directory, release_directory)
+        ])
+        _step_done('push:prepare')
+
+    # Push
+    plan = _push_plan(buildout_directory, annotate())
+
+    # Push the code into a new release populated with hard links to the
+    # unchanged files of the previous release (or the live directories)
+    if release:
+        previous = _current_release(buildout_directory)
+        for item in plan:
+            if not _top_level_item(buildout_directory, item):
+                continue
+            item['root'] = release_directory
+            item['link_dest'] = previous and os.path.join(
+                releases_directory, previous) or buildout_directory
+
+    # Push the top-level directories as a single artifact (built only once
+    # for all the hosts)
+    if artifact_push:
+        bundled = [item for item in plan
+                   if _top_level_item(buildout_directory, item)]
+        if _step_pending('push:artifact'):
+            _push_artifact(buildout_directory, bundled, effective_user)
+            _step_done('push:artifact')
+        for item in bundled:
+            item.update({'link_dest': None, 'only': []})
+
+    items = dict([(item['name'], item) for item in plan])
+    remote_directory = lambda item: _push_remote_directory(
+        buildout_directory, item)
+    previous_directory = lambda item: _push_remote_directory(
+        buildout_directory, dict(item, root=item['link_dest'] or item['root']))
+
+    # Push only the parts (and their scripts) changed since the last push
+    removed_paths = []
+    if changed_parts:
+        installed_path = os.path.join(buildout_directory, '.installed.cfg')
+        with open(installed_path) as installed_file:
+            local_installed = _installed_parts(installed_file.read())
+        remote_installed = _remote_installed_parts(
+            items['parts']['link_dest'] or items['parts']['root'])
+        # Recipes regenerate their files also when only the eggs they
+        # resolve have changed, which .installed.cfg does not record
+        fingerprints = _part_fingerprints(local_installed)
+        pushed = _load_state('parts', {}).get(_env.host_string)
+        if remote_installed is not None and pushed is not None:
+            changed = [part for part in local_installed
+                       if fingerprints[part] != pushed.get(part)]
+            removed = [part for part in remote_installed
+                       if part not in local_installed]
+            for name in ('bin', 'parts'):
+                removed_paths.extend([
+                    os.path.join(remote_directory(items[name]), path)
+                    for path in _installed_names(items[name]['directory'],
+                                                 remote_installed, removed)])
+            items['parts']['only'] = sorted(set(_installed_names(
+                items['parts']['directory'], local_installed, changed) + [
+                part for part in changed if os.path.exists(
+                    os.path.join(items['parts']['directory'], part))] +
+                _load_state('precompiled', {}).get('parts', [])))
+
+    # Push only the eggs missing from the remote egg manifest
+    if egg_manifest:
+        eggs_item = items['eggs']
+        remote_eggs_directory = remote_directory(eggs_item)
+        local_manifest = _egg_manifest(eggs_item['directory'])
+        remote_manifest = _remote_egg_manifest(previous_directory(eggs_item))
+        eggs_item['only'] = sorted([
+            name for name, checksum in local_manifest.items()
+            if remote_manifest.get(name) != checksum])
+
+    # Seed a new release with hard links to the previous release for the
+    # directories, which are only partially pushed
+    if _step_pending('push:seed'):
+        _remote_batch([
+            'mkdir -p {0:s} && {{ ! test -d {1:s} || '
+            'cp -al {1:s}/. {0:s}/; }}'.format(remote_directory(item),
+                                               previous_directory(item))
+            for item in plan
+            if item['only'] is not None and item['link_dest']])
+        _step_done('push:seed')
+
+    # Remove the removed parts (and their scripts)
+    _remote_batch(['rm -rf {0:s}'.format(' '.join(
+        [_quote(path) for path in removed_paths]))] if removed_paths else [])
+
+    if egg_manifest:
+        # Link the eggs already in the shared egg store of the host
+        if egg_store:
+            linked = _link_from_egg_store(egg_store, remote_eggs_directory,
+                                          local_manifest, eggs_item['only'])
+            eggs_item['only'] = [name for name in eggs_item['only']
+                                 if name not in linked]
+
+    if single_pass and _step_pending('push:single-pass'):
+        plan = _push_single_pass(buildout_directory, plan, effective_user)
+        _step_done('push:single-pass')
+    elif single_pass:
+        plan = [item for item in plan if os.path.relpath(
+            item['directory'], buildout_directory).startswith(os.pardir)]
+
+    for item in plan:
+        if not _step_pending('push:{0:s}'.format(item['name'])):
+            continue
+        directory = item['directory']
+        extra_opts = item['extra_opts']
+        if item['link_dest']:
+            extra_opts += ' --link-dest={0:s}'.format(
+                _push_remote_directory(buildout_directory,
+                                       dict(item, root=item['link_dest'])))
+        if item['only'] is None:
+            _rsync(_push_remote_directory(buildout_directory, item),
+                   os.path.join(directory, '*'),
+                   reverse=True, delete=False, exclude=item['exclude'],
+                   extra_opts=extra_opts.strip(),
+                   chown=item['chown'] and effective_user or None)
+        elif item['only']:
+            _push_only(buildout_directory, item, extra_opts.strip(),
+                       effective_user)
+        _step_done('push:{0:s}'.format(item['name']))
+
+    # Update the remote .installed.cfg
+    if changed_parts:
+        _rsync(items['parts']['root'] + '/', installed_path, reverse=True,
+               delete=False, chown=effective_user)
+        _save_state('precompiled', {})
+        state = _load_state('parts', {})
+        state[_env.host_string] = fingerprints
+        _save_state('parts', state)
+
+    # Update the remote egg manifest (and the shared egg store)
+    if egg_manifest:
+        if egg_store:
+            _add_to_egg_store(egg_store, remote_eggs_directory,
+                              local_manifest, eggs_item['only'])
+        remote_manifest.update(local_manifest)
+        _upload_egg_manifest(remote_eggs_directory, remote_manifest,
+                             effective_user)
+
+    # Switch to the new release
+    if release and _step_pending('push:activate'):
+        _remote_batch([
+            _activate_release_cmd(buildout_directory, release),
+            _prune_releases_cmd(
+                buildout_directory,
+                int(_env.hostout.options.get('keep-releases') or 5), release)
+        ])
+        _step_done('push:activate')
+
+
+@_task
 def deploy_etc():
     """Copy system config from parts/system/etc to /etc
     """
@@ -423,34 +2571,426 @@ def deploy_etc():
     buildout_sub_directory = lambda x: os.path.join(buildout_directory, x)
     parts_directory = buildout_sub_directory(annotations['parts-directory'])
 
-    if os.path.isdir('%s/system/etc' % parts_directory):
+    if os.path.isdir('%s/system/etc' % parts_directory) \
+            and _step_pending('deploy_etc'):
         cmd = 'cp -R %s /etc;supervisorctl reread;supervisorctl update' % \
               (parts_directory + '/system/etc/*')
 
-        if _env.hostout.options.get('remote-sudo') == 'true':
-            _sudo(cmd)
-        else:
-            _run(cmd)
+        _remote(cmd)
+        _step_done('deploy_etc')
+
 
+def _instances():
+    """Return the instances of the remote site from ``instances``
+    -hostout-option as a list of (supervisor program name, health check URL
+    or None) -tuples.
 
-def deploy():
-    """Deploys the local buildout to the remote site
     """
+    instances = []
+    for line in (_env.hostout.options.get('instances') or '').split('\n'):
+        if line.split():
+            name, url = (line.split() + [None])[:2]
+            instances.append((name, url))
+    return instances
 
-    # Push the code
-    push()
-    deploy_etc()
 
-    # Restart
+def _wait_instance_cmd(name, url, timeout):
+    """Return command, which waits until the given instance is ready (its
+    health check URL responds or supervisor reports it running) or fails
+    after the given timeout.
+
+    """
+    if url:
+        check = 'curl -sf -o /dev/null --max-time 5 {0:s}'.format(_quote(url))
+    else:
+        check = 'supervisorctl status {0:s} | grep -q RUNNING'.format(name)
+    return ('deadline=$(($(date +%s) + {0:d})); until {1:s}; do '
+            '[ $(date +%s) -lt $deadline ] || exit 1; sleep 2; done').format(
+        timeout, check)
+
+
+def _rolling_restart():
+    """Restart the instances of the remote site a batch (of
+    ``restart-batch`` -hostout-option instances, default: 1) at a time and
+    wait for each batch to become ready (for at most ``restart-timeout``
+    -hostout-option seconds, default: 120) before restarting the next.
+
+    """
+    instances = _instances()
+    batch = int(_env.hostout.options.get('restart-batch') or 1)
+    timeout = int(_env.hostout.options.get('restart-timeout') or 120)
+
+    assert instances, u'No instances found for the selected hostout'
+    assert batch > 0, u'Restart batch must be a positive number'
+
+    for i in range(0, len(instances), batch):
+        names = [name for name, url in instances[i:i + batch]]
+        step = 'restart:{0:s}'.format(' '.join(names))
+        if not _step_pending(step):
+            continue
+        cmds = ['supervisorctl restart {0:s}'.format(' '.join(names))]
+        cmds.extend([_wait_instance_cmd(name, url, timeout)
+                     for name, url in instances[i:i + batch]])
+        with _settings(warn_only=True):
+            results = _remote_batch(cmds)
+        if len(results) < 2 or results[0][1] != 0:
+            _abort(u'Restart failed for: {0:s}'.format(' '.join(names)))
+        if len(results) < len(cmds) or results[-1][1] != 0:
+            pending = [name for name, url in instances[i + batch:]]
+            _abort(u'Instance {0:s} did not come up within {1:d} seconds '
+                   u'(not restarted: {2:s})'.format(
+                       names[len(results) - 2], timeout,
+                       ' '.join(pending) or '-'))
+        if _output.running:
+            print('[localhost] restart: {0:s} ready'.format(' '.join(names)))
+        _step_done(step)
+
+
+def _restart_remote():
+    """Run the configured restart commands on the remote site (or restart
+    its instances one batch at a time, when ``rolling-restart``
+    -hostout-option is set).
+    """
+    if _env.hostout.options.get('rolling-restart') == 'true':
+        return _rolling_restart()
+
     cmds = filter(bool, _env.hostout.options.get('restart').split('\n'))
 
     assert cmds, u'No restart commands found for the selected hostout'
 
-    for cmd in cmds:
-        if _env.hostout.options.get('remote-sudo') == 'true':
-            _sudo(cmd)
+    _remote_batch(cmds)
+
+
+def _deploy_fingerprint():
+    """Return fingerprint of the staged buildout to be deployed: the local
+    .installed.cfg and the names of the eggs and scripts.
+
+    """
+    buildout_directory = _env.hostout.options.get('path')
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    annotations = annotate()
+    checksum = hashlib.sha1()
+    installed_path = os.path.join(buildout_directory, '.installed.cfg')
+    if os.path.exists(installed_path):
+        with open(installed_path, 'rb') as installed_file:
+            checksum.update(installed_file.read())
+    for name in ('eggs-directory', 'bin-directory'):
+        directory = os.path.join(buildout_directory, annotations[name])
+        if os.path.isdir(directory):
+            checksum.update('\n'.join(
+                sorted(os.listdir(directory))).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+@_task
+def deploy(*args):
+    """Deploys the local buildout to the remote site (or continues the last
+    failed deploy from its first incomplete step with ``--resume``)
+    """
+    fingerprint = _deploy_fingerprint()
+    checkpoint = '--resume' in args and _load_state('deploy') or {}
+    if '--resume' in args and not checkpoint.get('steps'):
+        print('[localhost] resume: no failed deploy found; deploying')
+    elif checkpoint.get('steps') \
+            and checkpoint.get('fingerprint') != fingerprint:
+        print('[localhost] resume: the buildout has been staged again since '
+              'the failed deploy; deploying from the start')
+        checkpoint = {}
+    checkpoint.setdefault('steps', [])
+    checkpoint['fingerprint'] = fingerprint
+    _save_state('deploy', checkpoint)
+    _env['pushdeploy_checkpoint'] = checkpoint
+
+    try:
+        # Push the code
+        push()
+        deploy_etc()
+
+        # Restart
+        with _phase('restart'):
+            if _step_pending('restart'):
+                _restart_remote()
+                _step_done('restart')
+    finally:
+        _env['pushdeploy_checkpoint'] = None
+
+    # Clear the checkpoint of the completed deploy
+    _save_state('deploy', {})
+
+
+@_task
+def rollback(release=None):
+    """Re-point the remote site to the previous (or the given) release and
+    restart it
+    """
+    buildout_directory = _env.hostout.options.get('path')
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    with _hide('stdout'):
+        releases = sorted(_remote('ls -1 {0:s}'.format(
+            os.path.join(buildout_directory, 'releases'))).split())
+    current = _current_release(buildout_directory)
+
+    if release is None:
+        assert current in releases, \
+            u'No current release found for the selected hostout ' \
+            u'(rollback with an explicit release)'
+        previous = [name for name in releases if name < current]
+        assert previous, u'No previous release found for the selected hostout'
+        release = previous[-1]
+
+    assert release in releases, \
+        u'No release {0:s} found for the selected hostout'.format(release)
+
+    _remote_batch([_activate_release_cmd(buildout_directory, release)])
+
+    # Restart
+    _restart_remote()
+
+
+_PLAN_MARKER = '[pushdeploy:plan]'
+
+
+def _plan_transfer(from_path, to_path, reverse=False, exclude=(), delete=False,
+                   extra_opts=''):
+    """Run the given rsync transfer in dry-run mode and return a dict with
+    the count and total size of the files, which would be transferred (or
+    None, when the dry-run fails).
+
+    """
+    extra_opts = (extra_opts + ' --dry-run --stats --out-format='
+                  '"{0:s}%i %l %n"'.format(_PLAN_MARKER)).strip()
+    with _settings(warn_only=True):
+        with _hide('stdout', 'warnings'):
+            res = _rsync(from_path, to_path, reverse=reverse, exclude=exclude,
+                         delete=delete, extra_opts=extra_opts, capture=True,
+                         compress=False)
+    if res.failed:
+        return None
+
+    files, size, deleted = 0, 0, 0
+    for line in res.splitlines():
+        if not line.startswith(_PLAN_MARKER):
+            continue
+        item, length = line[len(_PLAN_MARKER):].split(' ', 2)[:2]
+        if item.startswith('*'):  # e.g. '*deleting'
+            deleted += 1
+        elif item[:2] in ('<f', '>f'):
+            files += 1
+            size += int(length.replace(',', '') or 0)
+    return {'files': files, 'bytes': size, 'deleted': deleted}
+
+
+def _plan_throughput():
+    """Return the effective rsync throughput (transferred file bytes per
+    second) measured in the previous reports (or None, when there are no
+    reports with rsync statistics).
+
+    """
+    report_directory = _env.hostout.options.get('report-directory') or \
+        _state_path('reports')
+    if not os.path.isdir(report_directory):
+        return None
+
+    size, duration = 0, 0.0
+    for name in os.listdir(report_directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(report_directory, name)) as report_file:
+                report = json.load(report_file)
+        except (IOError, ValueError):
+            continue
+        if report.get('command') == 'plan':
+            continue
+        for record in report.get('invocations', []):
+            stats = record.get('stats') or {}
+            if record.get('type') != 'rsync' or record.get('failed') \
+                    or 'transferred_size' not in stats:
+                continue
+            size += stats['transferred_size']
+            duration += record.get('duration', 0.0)
+    return duration and size / duration or None
+
+
+def _format_size(size):
+    """Return the given number of bytes in a human readable form.
+    """
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    return '{0:.1f} {1:s}'.format(size, unit)
+
+
+@_task
+def plan():
+    """Show what push and pull would transfer (without transferring).
+    """
+
+    buildout_directory = _env.hostout.options.get('path')
+
+    assert buildout_directory, u'No path found for the selected hostout'
+
+    var_directory = os.path.join(buildout_directory, 'var')
+    datafs_path = os.path.join(var_directory, 'filestorage', 'Data.fs')
+
+    transfers = []
+    for item in _push_plan(buildout_directory, annotate()):
+        transfers.append(('push', item['directory'], _plan_transfer(
+            _push_remote_directory(buildout_directory, item),
+            os.path.join(item['directory'], '*'), reverse=True,
+            exclude=item['exclude'], extra_opts=item['extra_opts'])))
+    transfers.append(('pull', datafs_path, _plan_transfer(
+        datafs_path, datafs_path, delete=True)))
+    transfers.append(('pull', os.path.join(var_directory, 'blobstorage'),
+                      _plan_transfer(os.path.join(var_directory,
+                                                  'blobstorage'),
+                                     var_directory, delete=True)))
+
+    total_files, total_size = 0, 0
+    for command, directory, result in transfers:
+        if result is None:
+            print('{0:s} {1:s}: dry-run failed'.format(command, directory))
+            continue
+        total_files += result['files']
+        total_size += result['bytes']
+        print('{0:s} {1:s}: {2:d} files, {3:s}, {4:d} deletions'.format(
+            command, directory, result['files'],
+            _format_size(result['bytes']), result['deleted']))
+    print('total: {0:d} files, {1:s}'.format(total_files,
+                                              _format_size(total_size)))
+
+    throughput = _plan_throughput()
+    if throughput:
+        print('estimated transfer time: {0:.0f} s (at {1:s}/s)'.format(
+            total_size / throughput, _format_size(throughput)))
+    else:
+        print('estimated transfer time: unknown (enable report to measure '
+              'the throughput)')
+
+
+def _many(command, args):
+    """Run the given hostout command for many hostout sections at once using
+    a bounded pool of workers and print a per-host summary at the end.
+
+    Positional arguments are hostout section names (or ``all`` for every
+    pushdeploy section) and optionally ``-jN`` or ``--jobs=N`` to override
+    the ``concurrency`` -hostout-option.
+
+    """
+    hostouts = _env.hostout.hostouts
+    concurrency = int(_env.hostout.options.get('concurrency') or 4)
+
+    sections = []
+    for arg in args:
+        if arg.startswith('--jobs='):
+            concurrency = int(arg[len('--jobs='):])
+        elif arg.startswith('-j'):
+            concurrency = int(arg[len('-j'):])
+        elif arg == 'all':
+            sections.extend(sorted([name for name, hostout
+                                    in hostouts.items()
+                                    if 'hostout.pushdeploy' in hostout.extends
+                                    and name not in sections]))
         else:
-            _run(cmd)
+            assert arg in hostouts, \
+                u'No hostout section found for {0:s}'.format(arg)
+            if arg not in sections:
+                sections.append(arg)
+
+    if not sections:
+        sections = sorted([name for name, hostout in hostouts.items()
+                           if 'hostout.pushdeploy' in hostout.extends])
+
+    assert sections, u'No pushdeploy hostout sections found'
+    assert concurrency > 0, u'Concurrency must be a positive number'
+
+    # Sections relaying their artifact from another selected section wait
+    # for it to finish (whatever its result, because a missing artifact is
+    # uploaded from the local site instead)
+    relays = {}
+    for section in sections:
+        relay = hostouts[section].options.get('artifact-relay')
+        if relay in sections and relay != section:
+            relays[section] = relay
+    for section in sections:
+        seen = [section]
+        while seen[-1] in relays:
+            assert relays[seen[-1]] not in seen, \
+                u'Artifact relays form a cycle: {0:s}'.format(' '.join(seen))
+            seen.append(relays[seen[-1]])
+
+    results = {}
+
+    pending = list(sections)
+    running = set()
+    condition = threading.Condition()
+
+    def worker():
+        while True:
+            with condition:
+                while True:
+                    if not pending:
+                        return
+                    ready = [section for section in pending
+                             if relays.get(section) not in pending
+                             and relays.get(section) not in running]
+                    if ready:
+                        break
+                    condition.wait()
+                section = ready[0]
+                pending.remove(section)
+                running.add(section)
+            started = time.time()
+            returncode = _run_hostout(section, command)
+            with condition:
+                results[section] = (returncode, time.time() - started)
+                running.remove(section)
+                condition.notify_all()
+
+    if _output.running:
+        print('[localhost] {0:s}: {1:s} (concurrency {2:d})'.format(
+            command, ' '.join(sections), concurrency))
+
+    workers = [threading.Thread(target=worker)
+               for i in range(min(concurrency, len(sections)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    # Summary
+    failed = [section for section in sections if results[section][0] != 0]
+    print('')
+    print('Summary for {0:s}:'.format(command))
+    for section in sections:
+        returncode, duration = results[section]
+        print('  {0:s} {1:s} ({2:.1f}s)'.format(
+            section.ljust(max([len(name) for name in sections])),
+            returncode == 0 and 'OK' or 'FAILED (exit {0:d})'.format(
+                returncode),
+            duration))
+
+    if failed:
+        _abort(u'{0:s} failed for: {1:s}'.format(command, ' '.join(failed)))
+
+
+def push_many(*args):
+    """Push the local buildouts of many hostout sections in parallel.
+    """
+    _many('push', args)
+
+
+def deploy_many(*args):
+    """Deploy the local buildouts of many hostout sections in parallel.
+    """
+    _many('deploy', args)
 
 
 def stage_supervisor():
@@ -488,6 +3028,7 @@ def stage_supervisor():
     _local(cmd)
 
 
+@_task
 def deploy_supervisor():
     """Update the remote supervisor configuration. Supervisord configuration
     path must be defined by setting a hostout-option ``supervisor-conf``.
@@ -507,12 +3048,10 @@ def deploy_supervisor():
            reverse=True, delete=False)
 
     # Update
-    if _env.hostout.options.get('remote-sudo') == 'true':
-        _sudo('supervisorctl update')
-    else:
-        _run('supervisorctl update')
+    _remote('supervisorctl update')
 
 
+@_task
 def cook_resources():
     """Cook plone resources on remote
     """
@@ -527,37 +3066,35 @@ def cook_resources():
     cmd = '{0:s}/bin/instance -O {1:s} run `which resourcecooker.py`'.format(
         buildout_directory, buildout_name
     )
-    res = _sudo(cmd, warn_only=True)
-    if res.failed:
-        cmd = cmd.replace('/bin/instance -O', '/bin/instance1 -O')
-        _sudo(cmd, warn_only=True)
+    with _settings(warn_only=True):
+        res = _remote(cmd, sudo=True)
+        if res.failed:
+            cmd = cmd.replace('/bin/instance -O', '/bin/instance1 -O')
+            _remote(cmd, sudo=True)
 
 
+@_task
 def stop():
     """Stop the remote site using supervisor
     """
     site = _env.hostout.options.get('hostname')
-    if _env.hostout.options.get('remote-sudo') == 'true':
-        _sudo('supervisorctl stop {0:s}:*'.format(site))
-    else:
-        _run('supervisorctl stop {0:s}:*'.format(site))
+    _remote('supervisorctl stop {0:s}:*'.format(site))
 
 
+@_task
 def start():
     """Start the remote site using supervisor
     """
     site = _env.hostout.options.get('hostname')
-    if _env.hostout.options.get('remote-sudo') == 'true':
-        _sudo('supervisorctl start %s:*' % site)
-    else:
-        _run('supervisorctl start %s:*' % site)
+    _remote('supervisorctl start %s:*' % site)
 
 
+@_task
 def restart():
     """Restart the remote site using supervisor
     """
+    if _env.hostout.options.get('rolling-restart') == 'true':
+        return _rolling_restart()
+
     site = _env.hostout.options.get('hostname')
-    if _env.hostout.options.get('remote-sudo') == 'true':
-        _sudo('supervisorctl restart %s:*' % site)
-    else:
-        _run('supervisorctl restart %s:*' % site)
+    _remote('supervisorctl restart %s:*' % site)